@@ -1,38 +1,41 @@
 import asyncio
 import websockets
-import json
+import orjson
 
 # Phase 4: Now using tunnel_id instead of slug
 TUNNEL_ID = "tunnel_test123"
 EDGE_WS = f"ws://localhost:8080/ws/{TUNNEL_ID}"
 
 
+async def handle(ws, data):
+    if data["type"] == "request":
+        print(f"→ Got request: {data['method']} {data['path']}")
+
+        response = {
+            "type": "response",
+            "request_id": data["request_id"],
+            "status": 200,
+            "headers": {"Content-Type": "application/json"},
+            "body": {"message": "Hello from local agent", "path": data["path"]}
+        }
+
+        await ws.send(orjson.dumps(response))
+        print(f"← Sent response")
+
+
 async def run():
+    # Keepalive is native WS PING/PONG; websockets answers pings automatically
     async with websockets.connect(EDGE_WS) as ws:
         print("✓ Connected to edge")
 
         while True:
+            # Edge sends binary frames; orjson.loads takes bytes or str
             msg = await ws.recv()
-            data = json.loads(msg)
-
-            if data["type"] == "request":
-                print(f"→ Got request: {data['method']} {data['path']}")
-
-                response = {
-                    "type": "response",
-                    "request_id": data["request_id"],
-                    "status": 200,
-                    "headers": {"Content-Type": "application/json"},
-                    "body": {"message": "Hello from local agent", "path": data["path"]}
-                }
-
-                await ws.send(json.dumps(response))
-                print(f"← Sent response")
-
-            elif data["type"] == "ping":
-                # Reply with pong
-                await ws.send(json.dumps({"type": "pong"}))
-                print("♥ Pong sent")
+            data = orjson.loads(msg)
+
+            # Edge may coalesce several queued requests into one batch frame
+            for item in data["items"] if data["type"] == "batch" else [data]:
+                await handle(ws, item)
 
 
 asyncio.run(run())
\ No newline at end of file
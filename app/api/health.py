@@ -1,4 +1,5 @@
 from fastapi import APIRouter
+from app.services.slug_cache import slug_cache
 
 router = APIRouter()
 
@@ -13,3 +14,9 @@ async def readiness():
     # Phase 0: always ready
     # Later: check Redis, CP, etc.
     return {"status": "ready"}
+
+
+@router.get("/stats/slug_cache")
+async def slug_cache_stats():
+    # Per-pod counts of where slug resolutions were served from
+    return dict(slug_cache.counters)
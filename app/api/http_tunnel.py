@@ -1,38 +1,116 @@
-import json
-import uuid
 import logging
-import re
+import sys
+import orjson
+from secrets import token_hex
 from fastapi import APIRouter, Request, HTTPException
 from fastapi.responses import JSONResponse, Response
-from app.services.tunnel_manager import tunnel_manager
-from app.services.tunnel_registry import tunnel_registry
+from app.services.tunnel_manager import TunnelClosed, tunnel_manager
+from app.services.tunnel_registry import SLUG_NOT_FOUND, tunnel_registry
+from app.services.slug_cache import CACHE_HIT_L1, CACHE_HIT_L2, CACHE_MISS, slug_cache
 from app.services.control_plane_client import control_plane_client
-from app.core.config import settings
+from app.core.config import MAX_WS_PAYLOAD, settings
 import asyncio
 
 router = APIRouter()
 logger = logging.getLogger(__name__)
 
+# Bound once; settings are frozen
+_TIMEOUT = settings.REQUEST_TIMEOUT_SECONDS
 
-@router.api_route("/local_tunnel/{slug}/{path:path}", methods=["GET", "POST", "PUT", "DELETE", "PATCH"])
-async def forward_request(slug: str, path: str, request: Request):
+# Headers that describe a single connection and must not be proxied
+HOP_BY_HOP = frozenset({
+    "content-length",
+    "transfer-encoding",
+    "connection",
+    "keep-alive",
+    "proxy-authenticate",
+    "proxy-authorization",
+    "te",
+    "trailers",
+    "upgrade",
+})
+
+
+def _strip_hop_by_hop(headers) -> dict:
+    """Copy headers in a single pass, dropping hop-by-hop entries."""
+    return {k: v for k, v in headers.items() if k.lower() not in HOP_BY_HOP}
+
+
+def _build_response(response_data: dict) -> Response:
     """
-    Phase 4: Routes HTTP requests through tunnels using slug resolution.
-    
-    Flow:
-    1. Check Redis cache for slug -> tunnel_id
-    2. If miss, call Control Plane to resolve
-    3. Cache the result
-    4. Forward request to tunnel
+    Turn an agent response envelope into an HTTP response.
+
+    Bodies are handed to Starlette as bytes so it never re-encodes them.
+    Content-Type stays a raw header: as media_type, Starlette would append
+    "; charset=utf-8" to text/* types and mislabel non-UTF-8 bodies.
     """
-    # Step 1: Check cache
-    tunnel_id = await tunnel_registry.get_cached_slug(slug)
-    
-    # Step 2: If cache miss, resolve via Control Plane
-    if not tunnel_id:
-        cp_result = await control_plane_client.resolve_slug(slug)
+    # Hop-by-hop headers dropped; Content-Length is recalculated
+    response_headers = _strip_hop_by_hop(response_data.get("headers", {}))
+
+    body = response_data.get("body", "")
+    if isinstance(body, str):
+        body = body.encode()
+    elif body is None:
+        body = b""
+    elif not isinstance(body, bytes):
+        # Structured JSON body (e.g. a dict) sent by the agent
+        body = orjson.dumps(body)
+
+    return Response(
+        status_code=response_data.get("status", 200),
+        content=body,
+        headers=response_headers,
+    )
+
+
+if sys.version_info >= (3, 11):
+    async def _wait_response(future: asyncio.Future):
+        """Await the tunnel reply under a timer, without wrapping it in a task."""
+        async with asyncio.timeout(_TIMEOUT):
+            return await future
+else:
+    async def _wait_response(future: asyncio.Future):
+        """Await the tunnel reply with a timeout."""
+        return await asyncio.wait_for(future, timeout=_TIMEOUT)
+
+
+async def _resolve_tunnel_id(slug: str) -> str:
+    """
+    Resolve slug -> tunnel_id.
+
+    Checks the in-process cache, then Redis, then the Control Plane
+    (the registry caches the result in Redis). Raises 404/410 if the
+    slug cannot be routed, and 503 if the Control Plane is unreachable;
+    404s from the Control Plane are negatively cached. Stale results
+    served during a Control Plane outage are not cached.
+    """
+    tunnel_id = slug_cache.get(slug)
+    if tunnel_id:
+        slug_cache.count(CACHE_HIT_L1)
+        if tunnel_id is SLUG_NOT_FOUND:
+            raise HTTPException(status_code=404, detail="Slug not found")
+        return tunnel_id
+
+    tunnel_id, cp_result = await tunnel_registry.try_cache_then_resolve(
+        slug, lambda: control_plane_client.resolve_slug(slug)
+    )
+
+    if tunnel_id is SLUG_NOT_FOUND:
+        slug_cache.count(CACHE_HIT_L2)
+        slug_cache.set_not_found(slug)
+        raise HTTPException(status_code=404, detail="Slug not found")
+
+    if tunnel_id:
+        slug_cache.count(CACHE_HIT_L2)
+    else:
+        # Cache miss, resolved via Control Plane (Redis already updated)
+        slug_cache.count(CACHE_MISS)
         
         if not cp_result:
+            raise HTTPException(status_code=503, detail="Control Plane unavailable")
+
+        if cp_result.get("status") == "not_found":
+            slug_cache.set_not_found(slug)
             raise HTTPException(status_code=404, detail="Slug not found")
         
         tunnel_id = cp_result.get("tunnel_id")
@@ -44,22 +122,53 @@ async def forward_request(slug: str, path: str, request: Request):
                 status_code=410,
                 detail=f"Tunnel {status}"
             )
-        
-        # Step 3: Cache the resolution
-        await tunnel_registry.cache_slug_resolution(slug, tunnel_id)
+        if cp_result.get("stale"):
+            return tunnel_id
+
+    slug_cache.set(slug, tunnel_id)
+    return tunnel_id
+
+
+_TUNNEL_PREFIX = "/local_tunnel/"
+
+
+def _slug_from_referer(referer: str) -> str:
+    """Return the slug following /local_tunnel/ in the referer, or ''."""
+    start = referer.find(_TUNNEL_PREFIX)
+    if start < 0:
+        return ""
+    rest = referer[start + len(_TUNNEL_PREFIX):]
+    end = rest.find("/")
+    return rest if end < 0 else rest[:end]
+
+
+@router.api_route("/local_tunnel/{slug}/{path:path}", methods=["GET", "POST", "PUT", "DELETE", "PATCH"])
+async def forward_request(slug: str, path: str, request: Request):
+    """
+    Phase 4: Routes HTTP requests through tunnels using slug resolution.
+    
+    Flow:
+    1. Check in-process cache, then Redis cache, for slug -> tunnel_id
+    2. If miss, call Control Plane to resolve
+    3. Cache the result
+    4. Forward request to tunnel
+    """
+    # Steps 1-3: Resolve slug through the local cache, Redis, then Control Plane
+    tunnel_id = await _resolve_tunnel_id(slug)
     
-    # Step 4: Get tunnel websocket (using tunnel_id now)
-    websocket = tunnel_manager.get_tunnel(tunnel_id)
+    # Step 4: Get tunnel (using tunnel_id now)
+    tunnel = tunnel_manager.get_tunnel(tunnel_id)
 
-    if not websocket:
+    if not tunnel:
         # Tunnel not connected to this pod
         # For Phase 4, we just return 503 (Phase 8 will add inter-pod routing)
+        slug_cache.invalidate(slug)
         raise HTTPException(
             status_code=503,
             detail="Tunnel not connected to this pod"
         )
 
-    request_id = str(uuid.uuid4())
+    request_id = token_hex(16)
     body = await request.body()
 
     payload = {
@@ -67,44 +176,34 @@ async def forward_request(slug: str, path: str, request: Request):
         "request_id": request_id,
         "method": request.method,
         "path": f"/{path}",
-        "headers": dict(request.headers),
-        "body": body.decode() if body else None,
+        "headers": _strip_hop_by_hop(request.headers),
+        # Binary codecs carry the body as-is; JSON needs text
+        "body": (body if tunnel.codec.binary_bodies else body.decode()) if body else None,
     }
 
-    payload_text = json.dumps(payload)
-    if len(payload_text.encode("utf-8")) > settings.MAX_WS_PAYLOAD_BYTES:
+    payload_bytes = tunnel.codec.dumps(payload)
+    if len(payload_bytes) > MAX_WS_PAYLOAD:
         raise HTTPException(status_code=413, detail="Request payload too large for tunnel")
 
-    future = tunnel_manager.create_pending_request(request_id)
+    future = tunnel_manager.create_pending_request(request_id, tunnel)
 
-    try:
-        await websocket.send_text(payload_text)
-    except Exception:
-        # Sending failed; cleanup and return 502
-        tunnel_manager.pending_requests.pop(request_id, None)
+    if not tunnel_manager.enqueue(tunnel_id, payload_bytes):
+        # Tunnel went away before the request could be queued
+        tunnel_manager.cancel_pending_request(request_id)
+        slug_cache.invalidate(slug)
         raise HTTPException(status_code=502, detail="Failed to send to tunnel")
 
     try:
-        response_data = await asyncio.wait_for(
-            future, timeout=settings.REQUEST_TIMEOUT_SECONDS
-        )
+        response_data = await _wait_response(future)
     except asyncio.TimeoutError:
-        tunnel_manager.pending_requests.pop(request_id, None)
+        tunnel_manager.cancel_pending_request(request_id)
         raise HTTPException(status_code=504, detail="Tunnel timeout")
-
-    # Get headers but remove Content-Length (will be recalculated by FastAPI)
-    response_headers = response_data.get("headers", {})
-    response_headers = {k: v for k, v in response_headers.items() 
-                       if k.lower() not in ['content-length', 'transfer-encoding']}
+    except TunnelClosed:
+        slug_cache.invalidate(slug)
+        raise HTTPException(status_code=502, detail="Tunnel closed before responding")
 
     # Return raw response body (it's already properly formatted from local server)
-    body = response_data.get("body", "")
-    
-    return Response(
-        status_code=response_data.get("status", 200),
-        content=body,
-        headers=response_headers,
-    )
+    return _build_response(response_data)
 
 
 @router.api_route("/static/{path:path}", methods=["GET"])
@@ -116,8 +215,12 @@ async def proxy_static_to_tunnel(path: str, request: Request):
     
     Uses the Referer header to determine which tunnel should handle the request.
     """
+    # Copy headers once; the referer comes from the same pass
+    # (ASGI header names are lowercase, so this is a plain dict hit)
+    fwd_headers = _strip_hop_by_hop(request.headers)
+
     # Get the referer to determine which tunnel to use
-    referer = request.headers.get("referer", "")
+    referer = fwd_headers.get("referer", "")
     
     if not referer:
         raise HTTPException(
@@ -126,87 +229,58 @@ async def proxy_static_to_tunnel(path: str, request: Request):
         )
     
     # Extract slug from referer (e.g., /local_tunnel/my-slug/docs)
-    match = re.search(r'/local_tunnel/([^/]+)', referer)
-    if not match:
+    slug = _slug_from_referer(referer)
+    if not slug:
         raise HTTPException(
             status_code=404, 
             detail="Cannot determine tunnel from referer"
         )
     
-    slug = match.group(1)
     logger.info(f"Static asset request for /{path} from tunnel slug: {slug}")
     
-    # Step 1: Check cache for slug resolution
-    tunnel_id = await tunnel_registry.get_cached_slug(slug)
-    
-    # Step 2: If cache miss, resolve via Control Plane
-    if not tunnel_id:
-        cp_result = await control_plane_client.resolve_slug(slug)
-        
-        if not cp_result:
-            raise HTTPException(status_code=404, detail="Slug not found")
-        
-        tunnel_id = cp_result.get("tunnel_id")
-        status = cp_result.get("status")
-        
-        # Validate tunnel is active
-        if status != "active":
-            raise HTTPException(
-                status_code=410,
-                detail=f"Tunnel {status}"
-            )
-        
-        # Step 3: Cache the resolution
-        await tunnel_registry.cache_slug_resolution(slug, tunnel_id)
+    # Steps 1-3: Resolve slug through the local cache, Redis, then Control Plane
+    tunnel_id = await _resolve_tunnel_id(slug)
     
-    # Step 4: Get tunnel websocket
-    websocket = tunnel_manager.get_tunnel(tunnel_id)
+    # Step 4: Get tunnel
+    tunnel = tunnel_manager.get_tunnel(tunnel_id)
 
-    if not websocket:
+    if not tunnel:
+        slug_cache.invalidate(slug)
         raise HTTPException(
             status_code=503,
             detail="Tunnel not connected to this pod"
         )
 
-    request_id = str(uuid.uuid4())
+    request_id = token_hex(16)
 
     payload = {
         "type": "request",
         "request_id": request_id,
         "method": "GET",
         "path": f"/static/{path}",
-        "headers": dict(request.headers),
+        "headers": fwd_headers,
         "body": None,
     }
 
-    payload_text = json.dumps(payload)
-    
-    future = tunnel_manager.create_pending_request(request_id)
+    payload_bytes = tunnel.codec.dumps(payload)
+    if len(payload_bytes) > MAX_WS_PAYLOAD:
+        raise HTTPException(status_code=413, detail="Request payload too large for tunnel")
 
-    try:
-        await websocket.send_text(payload_text)
-    except Exception:
-        tunnel_manager.pending_requests.pop(request_id, None)
+    future = tunnel_manager.create_pending_request(request_id, tunnel)
+
+    if not tunnel_manager.enqueue(tunnel_id, payload_bytes):
+        tunnel_manager.cancel_pending_request(request_id)
+        slug_cache.invalidate(slug)
         raise HTTPException(status_code=502, detail="Failed to send to tunnel")
 
     try:
-        response_data = await asyncio.wait_for(
-            future, timeout=settings.REQUEST_TIMEOUT_SECONDS
-        )
+        response_data = await _wait_response(future)
     except asyncio.TimeoutError:
-        tunnel_manager.pending_requests.pop(request_id, None)
+        tunnel_manager.cancel_pending_request(request_id)
         raise HTTPException(status_code=504, detail="Tunnel timeout")
-
-    # Get headers but remove Content-Length (will be recalculated by FastAPI)
-    response_headers = response_data.get("headers", {})
-    response_headers = {k: v for k, v in response_headers.items() 
-                       if k.lower() not in ['content-length', 'transfer-encoding']}
+    except TunnelClosed:
+        slug_cache.invalidate(slug)
+        raise HTTPException(status_code=502, detail="Tunnel closed before responding")
 
     # Return raw response body
-    body = response_data.get("body", "")
-    
-    return Response(
-        status_code=response_data.get("status", 200),
-        content=body,
-        headers=response_headers,
-    )
+    return _build_response(response_data)
@@ -1,45 +1,30 @@
-import asyncio
-import json
 import logging
 from fastapi import APIRouter, WebSocket, WebSocketDisconnect, Header
 from typing import Optional
-from app.services.tunnel_manager import tunnel_manager
+from app.core.codec import get_codec
+from app.services.tunnel_manager import Tunnel, tunnel_manager
 from app.services.control_plane_client import control_plane_client
-from app.core.config import settings
 
 router = APIRouter()
 logger = logging.getLogger(__name__)
 
 
-async def _heartbeat_loop(tunnel_id: str, websocket: WebSocket):
-    """Application-level ping/pong loop. Sends 'ping' messages and expects 'pong'."""
-    ping_interval = settings.WS_PING_INTERVAL_SECONDS
-    pong_timeout = settings.WS_PONG_TIMEOUT_SECONDS
-    while True:
-        await asyncio.sleep(ping_interval)
-        ping_msg = json.dumps({"type": "ping"})
-        try:
-            await websocket.send_text(ping_msg)
-        except Exception:
-            logger.warning("Failed to send ping, closing", extra={"tunnel_id": tunnel_id})
-            try:
-                await websocket.close()
-            except Exception:
-                pass
-            return
-
-        # wait for pong by checking last_pong timestamp
-        await asyncio.sleep(pong_timeout)
-        t = tunnel_manager.active_tunnels.get(tunnel_id)
-        if not t:
-            return
-        if (asyncio.get_event_loop().time() - t.last_pong) > (ping_interval + pong_timeout):
-            logger.warning("Pong timeout, closing connection", extra={"tunnel_id": tunnel_id})
-            try:
-                await websocket.close()
-            except Exception:
-                pass
-            return
+async def _handle_message(tunnel: Tunnel, data: dict):
+    """Dispatch a single decoded tunnel message."""
+    tunnel_id = tunnel.tunnel_id
+    mtype = data.get("type")
+    if mtype == "response":
+        request_id = data.get("request_id")
+        if request_id:
+            tunnel_manager.resolve_request(request_id, data)
+    elif mtype == "pong":
+        tunnel_manager.set_pong(tunnel_id)
+    elif mtype == "ping":
+        # Legacy app-level ping from older agents; the pong goes through the
+        # tunnel's writer task like every other outbound frame
+        tunnel_manager.enqueue(tunnel_id, tunnel.codec.pong)
+    else:
+        logger.debug("Unhandled WS message type", extra={"tunnel_id": tunnel_id, "type": mtype})
 
 
 @router.websocket("/ws/{tunnel_id}")
@@ -64,6 +49,18 @@ async def websocket_tunnel(websocket: WebSocket, tunnel_id: str):
         await websocket.close(code=1008, reason="Missing X-Tunnel-Token header")
         return
     
+    # Wire encoding is negotiated once per connection (JSON by default)
+    encoding = websocket.headers.get("x-tunnel-encoding")
+    codec = get_codec(encoding)
+    if not codec:
+        logger.warning(
+            "Tunnel connection rejected - unsupported encoding",
+            extra={"tunnel_id": tunnel_id, "encoding": encoding}
+        )
+        await websocket.accept()
+        await websocket.close(code=1008, reason=f"Unsupported X-Tunnel-Encoding: {encoding}")
+        return
+    
     # Validate tunnel with Control Plane
     validation_result = await control_plane_client.validate_tunnel(tunnel_id, tunnel_token)
     
@@ -101,7 +98,7 @@ async def websocket_tunnel(websocket: WebSocket, tunnel_id: str):
     await websocket.accept()
     
     try:
-        tunnel = await tunnel_manager.register_tunnel(tunnel_id, websocket)
+        tunnel = await tunnel_manager.register_tunnel(tunnel_id, websocket, codec)
     except ValueError as e:
         logger.warning("Tunnel registration failed", extra={"tunnel_id": tunnel_id, "error": str(e)})
         await websocket.close(code=1008, reason=str(e))
@@ -109,45 +106,41 @@ async def websocket_tunnel(websocket: WebSocket, tunnel_id: str):
     
     logger.info(
         "Tunnel connected and validated",
-        extra={"tunnel_id": tunnel_id, "expires_at": validation_result.get("expires_at")}
+        extra={
+            "tunnel_id": tunnel_id,
+            "expires_at": validation_result.get("expires_at"),
+            "encoding": codec.name,
+        }
     )
 
-    # start heartbeat task
-    tunnel.heartbeat_task = asyncio.create_task(_heartbeat_loop(tunnel_id, websocket))
+    # Keepalive uses native WebSocket PING/PONG frames handled by the server
+    # (ws_ping_interval / ws_ping_timeout in app.main), so no app-level loop
 
     try:
         while True:
-            message = await websocket.receive_text()
+            # Agents may send text or binary frames
+            event = await websocket.receive()
+            if event["type"] == "websocket.disconnect":
+                raise WebSocketDisconnect(event.get("code", 1000))
+            message = event.get("bytes") or event.get("text")
 
             if not message:
                 continue
 
-            if len(message.encode("utf-8")) > settings.MAX_WS_PAYLOAD_BYTES:
-                logger.warning("Payload too large, closing", extra={"tunnel_id": tunnel_id})
-                await websocket.close(code=1009)
-                break
-
+            # Frame size is capped by the server (ws_max_size = MAX_WS_PAYLOAD_BYTES,
+            # see app.main), which closes oversized frames with 1009 before decoding
             try:
-                data = json.loads(message)
-            except json.JSONDecodeError:
-                logger.warning("Invalid JSON from tunnel", extra={"tunnel_id": tunnel_id})
+                data = codec.loads(message)
+            except ValueError:
+                logger.warning("Undecodable frame from tunnel", extra={"tunnel_id": tunnel_id, "encoding": codec.name})
                 continue
 
-            mtype = data.get("type")
-            if mtype == "response":
-                request_id = data.get("request_id")
-                if request_id:
-                    tunnel_manager.resolve_request(request_id, data)
-            elif mtype == "pong":
-                tunnel_manager.set_pong(tunnel_id)
-            elif mtype == "ping":
-                # reply with pong
-                try:
-                    await websocket.send_text(json.dumps({"type": "pong"}))
-                except Exception:
-                    pass
+            if data.get("type") == "batch":
+                # Agent coalesced several messages into one frame
+                for item in data.get("items", []):
+                    await _handle_message(tunnel, item)
             else:
-                logger.debug("Unhandled WS message type", extra={"tunnel_id": tunnel_id, "type": mtype})
+                await _handle_message(tunnel, data)
 
     except WebSocketDisconnect:
         logger.info("Tunnel disconnected", extra={"tunnel_id": tunnel_id})
@@ -0,0 +1,84 @@
+"""
+Wire codecs for tunnel envelopes.
+
+JSON (orjson) is the default encoding. Agents can opt into MessagePack by
+sending `X-Tunnel-Encoding: msgpack` when connecting; request and response
+bodies then travel as raw bytes instead of being UTF-8 decoded into JSON
+strings. Every envelope keeps its leading `type` field in both encodings.
+"""
+from typing import Dict, List, Optional, Union
+import msgpack
+import orjson
+
+
+class JSONCodec:
+    """Default codec. Bodies must be text, so they are UTF-8 decoded."""
+
+    name = "json"
+    binary_bodies = False
+    # '{"type":"batch","items":[' + ']}'
+    batch_overhead = 27
+
+    def __init__(self):
+        self.ping = self.dumps({"type": "ping"})
+        self.pong = self.dumps({"type": "pong"})
+
+    def dumps(self, obj) -> bytes:
+        return orjson.dumps(obj)
+
+    def loads(self, data: Union[bytes, str]):
+        """Decode a frame. Raises ValueError on malformed input."""
+        return orjson.loads(data)
+
+    def batch(self, frames: List[bytes]) -> bytes:
+        """Wrap already-encoded frames in a batch envelope without re-encoding."""
+        return b'{"type":"batch","items":[' + b",".join(frames) + b"]}"
+
+
+class MsgpackCodec:
+    """Binary codec. Bodies are carried as raw bytes."""
+
+    name = "msgpack"
+    binary_bodies = True
+    # fixmap + "type" + "batch" + "items" + array32 header
+    batch_overhead = 23
+
+    _BATCH_HEAD = b"\x82" + msgpack.packb("type") + msgpack.packb("batch") + msgpack.packb("items")
+
+    def __init__(self):
+        self._packer = msgpack.Packer(use_bin_type=True)
+        self.ping = self.dumps({"type": "ping"})
+        self.pong = self.dumps({"type": "pong"})
+
+    def dumps(self, obj) -> bytes:
+        return msgpack.packb(obj, use_bin_type=True)
+
+    def loads(self, data: Union[bytes, str]):
+        """Decode a frame. Raises ValueError on malformed input."""
+        if isinstance(data, str):
+            data = data.encode("utf-8")
+        try:
+            return msgpack.unpackb(data, raw=False)
+        except msgpack.UnpackException as e:
+            raise ValueError(str(e)) from e
+
+    def batch(self, frames: List[bytes]) -> bytes:
+        """Wrap already-encoded frames in a batch envelope without re-encoding."""
+        return self._BATCH_HEAD + self._packer.pack_array_header(len(frames)) + b"".join(frames)
+
+
+Codec = Union[JSONCodec, MsgpackCodec]
+
+JSON_CODEC = JSONCodec()
+
+CODECS: Dict[str, Codec] = {
+    JSON_CODEC.name: JSON_CODEC,
+    MsgpackCodec.name: MsgpackCodec(),
+}
+
+
+def get_codec(name: Optional[str]) -> Optional[Codec]:
+    """Look up a codec by X-Tunnel-Encoding value; JSON when unset."""
+    if not name:
+        return JSON_CODEC
+    return CODECS.get(name.strip().lower())
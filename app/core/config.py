@@ -1,7 +1,10 @@
-from pydantic_settings import BaseSettings
+from pydantic_settings import BaseSettings, SettingsConfigDict
 
 
 class Settings(BaseSettings):
+    # Frozen: hot paths bind settings to module-level constants at import
+    model_config = SettingsConfigDict(env_file=".env", frozen=True)
+
     APP_NAME: str = "bindu-edge-gateway"
     ENV: str = "dev"
     LOG_LEVEL: str = "INFO"
@@ -18,12 +21,26 @@ class Settings(BaseSettings):
     REDIS_DB: int = 0
     REDIS_PASSWORD: str | None = None
     TUNNEL_REGISTRY_TTL: int = 300  # 5 minutes
+    REDIS_MAX_CONNECTIONS: int = 64
+    REDIS_HEALTH_CHECK_INTERVAL: int = 30  # seconds idle before a PING on checkout
     # Phase 4 settings
     CONTROL_PLANE_URL: str = "http://localhost:8000"
+    CONTROL_PLANE_RETRIES: int = 2  # extra attempts on 5xx / timeout / connect error
+    CONTROL_PLANE_RETRY_BACKOFF: float = 0.05  # seconds, doubled per attempt
+    CONTROL_PLANE_RETRY_BACKOFF_MAX: float = 0.5
+    CONTROL_PLANE_MAX_INFLIGHT: int = 64  # concurrent CP calls per pod
+    CONTROL_PLANE_QUEUE_MAX: int = 256  # waiters beyond that fail fast
+    TUNNEL_VALIDATION_TTL: int = 10  # seconds to reuse a successful tunnel validation
     SLUG_CACHE_TTL: int = 60  # 60 seconds
-
-    class Config:
-        env_file = ".env"
+    SLUG_LOCAL_CACHE_SIZE: int = 1024  # in-process entries per pod
+    SLUG_LOCAL_CACHE_TTL: int = 30  # seconds, half of SLUG_CACHE_TTL
+    SLUG_BATCH_WINDOW_MS: float = 1.0  # coalesce Redis slug lookups
+    SLUG_NEG_CACHE_TTL: int = 10  # seconds to remember slugs the CP 404'd
+    SLUG_CLIENT_TRACKING: bool = True  # Redis-pushed invalidation of the in-process cache
+    SLUG_STALE_TTL: int = 300  # serve last good resolution this long while the CP is down
 
 
 settings = Settings()
+
+# Hot-path constants, bound once since settings are frozen
+MAX_WS_PAYLOAD = settings.MAX_WS_PAYLOAD_BYTES
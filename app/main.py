@@ -1,21 +1,35 @@
 import socket
 import uuid
 from fastapi import FastAPI
+from fastapi.responses import ORJSONResponse
 from app.api import health, http_tunnel, ws_tunnel
 from app.core.config import settings
 from app.core.logging import setup_logging
 from app.services.tunnel_registry import tunnel_registry
+from app.services.slug_cache import slug_cache
 from app.services.control_plane_client import control_plane_client
 import logging
 
 setup_logging()
 logger = logging.getLogger(__name__)
 
-app = FastAPI(title=settings.APP_NAME)
+app = FastAPI(title=settings.APP_NAME, default_response_class=ORJSONResponse)
 
 # Global pod_id (set at startup)
 POD_ID: str = ""
 
+# Set by the __main__ block below. Keepalive, the frame size limit and the
+# event loop are uvicorn options, so a bare `uvicorn app.main:app` launch
+# silently runs with uvicorn's defaults instead of these settings.
+LAUNCHED_WITH_SETTINGS = False
+
+UVICORN_FLAGS = (
+    f"--ws-ping-interval {settings.WS_PING_INTERVAL_SECONDS} "
+    f"--ws-ping-timeout {settings.WS_PONG_TIMEOUT_SECONDS} "
+    f"--ws-max-size {settings.MAX_WS_PAYLOAD_BYTES} "
+    "--loop uvloop --http httptools"
+)
+
 
 def generate_pod_id() -> str:
     """Generate unique pod identifier: hostname-shortid"""
@@ -30,6 +44,12 @@ async def startup_event():
     POD_ID = generate_pod_id()
     
     logger.info("Starting Edge Gateway", extra={"env": settings.ENV, "pod_id": POD_ID})
+    if not LAUNCHED_WITH_SETTINGS:
+        logger.warning(
+            "Not started via `python -m app.main`; WS keepalive, frame size and "
+            "loop settings only apply if the equivalent uvicorn flags are passed",
+            extra={"uvicorn_flags": UVICORN_FLAGS}
+        )
     
     # Initialize Redis tunnel registry
     try:
@@ -37,6 +57,10 @@ async def startup_event():
     except Exception as e:
         logger.error("Failed to connect to Redis", extra={"error": str(e)})
         raise
+
+    # Push slug invalidations into the in-process cache (falls back to TTLs)
+    if settings.SLUG_CLIENT_TRACKING:
+        await tunnel_registry.track_slugs(slug_cache.invalidate)
     
     # Initialize Control Plane client (Phase 4)
     try:
@@ -55,3 +79,22 @@ async def shutdown_event():
 app.include_router(health.router)
 app.include_router(ws_tunnel.router)
 app.include_router(http_tunnel.router)
+
+
+if __name__ == "__main__":
+    import uvicorn
+
+    LAUNCHED_WITH_SETTINGS = True
+    uvicorn.run(
+        app,
+        host=settings.HOST,
+        port=settings.PORT,
+        # uvloop + httptools are pinned in requirements; fail loudly if missing
+        loop="uvloop",
+        http="httptools",
+        # Oversized frames are rejected by the protocol layer before reaching the app
+        ws_max_size=settings.MAX_WS_PAYLOAD_BYTES,
+        # Keepalive via native WebSocket PING/PONG control frames
+        ws_ping_interval=settings.WS_PING_INTERVAL_SECONDS,
+        ws_ping_timeout=settings.WS_PONG_TIMEOUT_SECONDS,
+    )
@@ -4,12 +4,22 @@ Phase 4: Control Plane client for slug resolution.
 Communicates with Bindu Control Plane to resolve slugs to tunnel_ids
 and validate tunnel metadata.
 
+Requests are retried with jittered exponential backoff on 5xx, timeouts
+and connect errors. If the Control Plane stays unreachable, the last
+successful resolution for a slug is served stale for SLUG_STALE_TTL.
+
 MOCK MODE: Uses in-memory data instead of HTTP calls for testing.
 """
+import asyncio
+import hashlib
 import logging
-from typing import Optional
+import os
+import random
+from typing import Awaitable, Callable, Dict, Hashable, Optional
 from datetime import datetime, timedelta
 import httpx
+import orjson
+from cachetools import TTLCache
 from app.core.config import settings
 
 logger = logging.getLogger(__name__)
@@ -30,12 +40,37 @@ MOCK_TUNNELS = {
 }
 
 
+_EPOCH = datetime(1970, 1, 1)
+
+
+class ControlPlaneSaturated(RuntimeError):
+    """Too many Control Plane calls in flight or queued on this pod."""
+
+
+def _mock_expiry() -> dict:
+    """Mock expiry 24h out, as epoch seconds plus the transitional ISO string."""
+    dt = datetime.utcnow() + timedelta(hours=24)
+    return {"expires_at": int((dt - _EPOCH).total_seconds()), "expires_at_iso": dt.isoformat()}
+
+
 class ControlPlaneClient:
     """Client for communicating with Bindu Control Plane."""
 
     def __init__(self):
         self._client: Optional[httpx.AsyncClient] = None
         self._mock_mode = True  # Enable mock mode by default
+        # In-flight CP calls keyed by request; concurrent callers share one result
+        self._inflight: Dict[Hashable, asyncio.Task] = {}
+        # Last good resolve_slug result per slug, for stale-if-error
+        self._stale_slugs: TTLCache = TTLCache(
+            maxsize=settings.SLUG_LOCAL_CACHE_SIZE, ttl=settings.SLUG_STALE_TTL
+        )
+        # Positive validations by salted (tunnel_id, token) digest; absorbs reconnect storms
+        self._valid_cache: TTLCache = TTLCache(maxsize=4096, ttl=settings.TUNNEL_VALIDATION_TTL)
+        self._validation_salt = os.urandom(16)
+        # Bulkhead: bounded in-flight CP calls plus a bounded wait queue
+        self._sem = asyncio.Semaphore(settings.CONTROL_PLANE_MAX_INFLIGHT)
+        self._pending = 0  # in flight + queued
 
     async def connect(self):
         """Initialize HTTP client."""
@@ -43,9 +78,18 @@ class ControlPlaneClient:
             logger.info("Control Plane client initialized in MOCK MODE - no external calls")
             return
         
+        # One pooled client for the process; HTTP/2 multiplexes concurrent
+        # resolutions over a single connection when the CP speaks it (TLS)
         self._client = httpx.AsyncClient(
             base_url=settings.CONTROL_PLANE_URL,
-            timeout=httpx.Timeout(10.0),
+            # Per-phase bounds so a CP blip fails fast instead of after 10s
+            timeout=httpx.Timeout(connect=1.0, read=2.0, write=2.0, pool=1.0),
+            limits=httpx.Limits(
+                max_keepalive_connections=100,
+                max_connections=200,
+                keepalive_expiry=30.0,
+            ),
+            http2=True,
         )
         logger.info("Control Plane client initialized", extra={"base_url": settings.CONTROL_PLANE_URL})
 
@@ -61,10 +105,14 @@ class ControlPlaneClient:
         Returns:
             {
                 "tunnel_id": str,
-                "expires_at": str (ISO format),
+                "expires_at": int (epoch seconds),
+                "expires_at_iso": str (ISO format, transitional),
                 "status": str ("active" | "expired" | "revoked")
             }
-            or None if not found
+            {"tunnel_id": None, "status": "not_found"} if the slug is unknown,
+            or None if the Control Plane could not be reached. While it is
+            unreachable, the last good resolution may be returned instead,
+            with "stale": True.
         """
         # Mock mode - return in-memory data
         if self._mock_mode:
@@ -73,40 +121,59 @@ class ControlPlaneClient:
                 logger.info("Slug resolved (MOCK)", extra={"slug": slug, "tunnel_id": tunnel_id})
                 return {
                     "tunnel_id": tunnel_id,
-                    "expires_at": (datetime.utcnow() + timedelta(hours=24)).isoformat(),
+                    **_mock_expiry(),
                     "status": "active"
                 }
             logger.info("Slug not found (MOCK)", extra={"slug": slug})
-            return None
+            return {"tunnel_id": None, "status": "not_found"}
         
-        # Real mode - make HTTP call
+        # Real mode - make HTTP call (coalesced per slug)
+        return await self._single_flight(("resolve", slug), lambda: self._fetch_slug(slug))
+
+    async def _fetch_slug(self, slug: str) -> Optional[dict]:
+        """HTTP call behind resolve_slug."""
         if not self._client:
             raise RuntimeError("ControlPlaneClient not connected")
 
         try:
-            response = await self._client.get(f"/api/tunnels/resolve/{slug}")
+            response = await self._request("GET", f"/api/tunnels/resolve/{slug}")
             
             if response.status_code == 404:
                 logger.info("Slug not found in Control Plane", extra={"slug": slug})
-                return None
+                self._stale_slugs.pop(slug, None)
+                return {"tunnel_id": None, "status": "not_found"}
             
             if response.status_code != 200:
                 logger.error(
                     "Control Plane error",
                     extra={"slug": slug, "status_code": response.status_code}
                 )
-                return None
+                return self._stale_slug(slug)
             
-            data = response.json()
+            data = orjson.loads(response.content)
+            self._stale_slugs[slug] = data
             logger.info("Slug resolved", extra={"slug": slug, "tunnel_id": data.get("tunnel_id")})
             return data
         
         except httpx.TimeoutException:
             logger.error("Control Plane timeout", extra={"slug": slug})
-            return None
+            return self._stale_slug(slug)
         except Exception as e:
             logger.error("Control Plane request failed", extra={"slug": slug, "error": str(e)})
+            return self._stale_slug(slug)
+
+    def _stale_slug(self, slug: str) -> Optional[dict]:
+        """
+        Last good resolution for slug, if still within SLUG_STALE_TTL.
+
+        Marked "stale": True so callers can route with it without caching
+        it again under a fresh TTL.
+        """
+        data = self._stale_slugs.get(slug)
+        if not data:
             return None
+        logger.warning("Serving stale slug resolution", extra={"slug": slug})
+        return {**data, "stale": True}
 
     async def validate_tunnel(self, tunnel_id: str, token: str) -> Optional[dict]:
         """
@@ -124,7 +191,8 @@ class ControlPlaneClient:
                 "valid": bool,
                 "tunnel_id": str,
                 "status": str ("active" | "expired" | "revoked"),
-                "expires_at": str (ISO format),
+                "expires_at": int (epoch seconds),
+                "expires_at_iso": str (ISO format, transitional),
             }
             or None if validation request fails
         """
@@ -137,7 +205,7 @@ class ControlPlaneClient:
                     "valid": tunnel_info["valid"],
                     "tunnel_id": tunnel_id,
                     "status": tunnel_info["status"],
-                    "expires_at": (datetime.utcnow() + timedelta(hours=24)).isoformat()
+                    **_mock_expiry(),
                 }
             # Accept any tunnel_id in mock mode
             logger.info("Tunnel auto-validated (MOCK)", extra={"tunnel_id": tunnel_id})
@@ -145,15 +213,36 @@ class ControlPlaneClient:
                 "valid": True,
                 "tunnel_id": tunnel_id,
                 "status": "active",
-                "expires_at": (datetime.utcnow() + timedelta(hours=24)).isoformat()
+                **_mock_expiry(),
             }
         
-        # Real mode - make HTTP call
+        # Real mode - short-lived cache of positive results, then an HTTP
+        # call coalesced per (tunnel_id, token). The key is a salted digest
+        # so raw tokens are not kept as dict keys.
+        key = hashlib.blake2b(
+            f"{tunnel_id}:{token}".encode(), digest_size=16, key=self._validation_salt
+        ).digest()
+        cached = self._valid_cache.get(key)
+        if cached:
+            return cached
+
+        result = await self._single_flight(
+            ("validate", key),
+            lambda: self._fetch_validation(tunnel_id, token),
+        )
+        # Only successful validations are cached; rejections always re-check
+        if result and result.get("valid"):
+            self._valid_cache[key] = result
+        return result
+
+    async def _fetch_validation(self, tunnel_id: str, token: str) -> Optional[dict]:
+        """HTTP call behind validate_tunnel."""
         if not self._client:
             raise RuntimeError("ControlPlaneClient not connected")
 
         try:
-            response = await self._client.post(
+            response = await self._request(
+                "POST",
                 "/api/tunnels/validate",
                 json={"tunnel_id": tunnel_id, "token": token}
             )
@@ -179,7 +268,7 @@ class ControlPlaneClient:
                 )
                 return None
             
-            data = response.json()
+            data = orjson.loads(response.content)
             logger.info(
                 "Tunnel validation completed",
                 extra={"tunnel_id": tunnel_id, "valid": data.get("valid")}
@@ -196,6 +285,75 @@ class ControlPlaneClient:
             )
             return None
 
+    async def _request(self, method: str, url: str, **kwargs) -> httpx.Response:
+        """
+        Send a CP request, retrying 5xx, timeouts and connect errors.
+
+        Backoff doubles from CONTROL_PLANE_RETRY_BACKOFF up to
+        CONTROL_PLANE_RETRY_BACKOFF_MAX with random jitter. After the last
+        attempt the 5xx response is returned or the error re-raised.
+        """
+        retries = settings.CONTROL_PLANE_RETRIES
+        for attempt in range(retries + 1):
+            if attempt:
+                delay = min(
+                    settings.CONTROL_PLANE_RETRY_BACKOFF * 2 ** (attempt - 1),
+                    settings.CONTROL_PLANE_RETRY_BACKOFF_MAX,
+                )
+                await asyncio.sleep(delay + random.uniform(0, delay))
+            try:
+                response = await self._send(method, url, **kwargs)
+            except (httpx.TimeoutException, httpx.ConnectError):
+                if attempt == retries:
+                    raise
+                continue
+            if response.status_code < 500 or attempt == retries:
+                return response
+            logger.warning(
+                "Control Plane request failed, retrying",
+                extra={"url": url, "status_code": response.status_code, "attempt": attempt + 1}
+            )
+
+    async def _send(self, method: str, url: str, **kwargs) -> httpx.Response:
+        """
+        One CP HTTP call inside the bulkhead.
+
+        At most CONTROL_PLANE_MAX_INFLIGHT calls run at once; beyond
+        CONTROL_PLANE_QUEUE_MAX waiters, fail fast with ControlPlaneSaturated
+        so callers fall back to stale data instead of piling up.
+        """
+        if self._pending >= settings.CONTROL_PLANE_MAX_INFLIGHT + settings.CONTROL_PLANE_QUEUE_MAX:
+            raise ControlPlaneSaturated("Control Plane request queue full")
+        self._pending += 1
+        try:
+            async with self._sem:
+                return await self._client.request(method, url, **kwargs)
+        finally:
+            self._pending -= 1
+
+    async def _single_flight(
+        self, key: Hashable, fetch: Callable[[], Awaitable[Optional[dict]]]
+    ) -> Optional[dict]:
+        """
+        Run fetch() once per key at a time.
+
+        fetch() runs in its own task that every caller awaits through
+        shield(), so a caller that is cancelled (e.g. its client went away)
+        does not cancel the request for the others.
+        """
+        task = self._inflight.get(key)
+        if task is None:
+            task = asyncio.create_task(fetch())
+            self._inflight[key] = task
+            task.add_done_callback(lambda t: self._flight_done(key, t))
+        return await asyncio.shield(task)
+
+    def _flight_done(self, key: Hashable, task: asyncio.Task):
+        """Forget a finished flight and retrieve its error, even with no waiters left."""
+        if self._inflight.get(key) is task:
+            del self._inflight[key]
+        if not task.cancelled():
+            task.exception()
 
 # Global instance
 control_plane_client = ControlPlaneClient()
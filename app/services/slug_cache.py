@@ -0,0 +1,72 @@
+"""
+In-process slug cache (L1).
+
+Sits in front of the Redis slug cache (L2) and the Control Plane (origin)
+so hot slugs resolve with a dict lookup and no I/O. The gateway runs a
+single event loop per process, so no locking is needed.
+
+Counters track where each resolution was served from:
+- hit_l1: in-process cache
+- hit_l2: Redis slug cache
+- miss: resolved by the Control Plane
+
+Slugs the Control Plane does not know are remembered separately for
+SLUG_NEG_CACHE_TTL so floods of bad slugs do not reach the Control Plane.
+"""
+from typing import Dict, Optional, Union
+from cachetools import TTLCache
+from app.core.config import settings
+from app.services.tunnel_registry import SLUG_NOT_FOUND
+
+CACHE_HIT_L1 = "hit_l1"
+CACHE_HIT_L2 = "hit_l2"
+CACHE_MISS = "miss"
+
+
+class SlugCache:
+    """Bounded TTL cache of slug -> tunnel_id with hit/miss counters."""
+
+    def __init__(self, maxsize: int, ttl: float, neg_ttl: float):
+        self._cache: TTLCache = TTLCache(maxsize=maxsize, ttl=ttl)
+        self._neg_cache: TTLCache = TTLCache(maxsize=maxsize, ttl=neg_ttl)
+        self.counters: Dict[str, int] = {CACHE_HIT_L1: 0, CACHE_HIT_L2: 0, CACHE_MISS: 0}
+
+    def get(self, slug: str) -> Union[str, object, None]:
+        """Get tunnel_id for slug if cached locally, SLUG_NOT_FOUND if known bad."""
+        tunnel_id = self._cache.get(slug)
+        if tunnel_id is None and slug in self._neg_cache:
+            return SLUG_NOT_FOUND
+        return tunnel_id
+
+    def set(self, slug: str, tunnel_id: str):
+        """Cache slug -> tunnel_id."""
+        self._cache[slug] = tunnel_id
+        self._neg_cache.pop(slug, None)
+
+    def set_not_found(self, slug: str):
+        """Remember that slug is unknown to the Control Plane."""
+        self._neg_cache[slug] = True
+
+    def invalidate(self, slug: Optional[str]):
+        """
+        Drop slug, e.g. when its tunnel is not reachable from this pod or
+        Redis reports the key changed. None drops every entry.
+        """
+        if slug is None:
+            self._cache.clear()
+            self._neg_cache.clear()
+            return
+        self._cache.pop(slug, None)
+        self._neg_cache.pop(slug, None)
+
+    def count(self, outcome: str):
+        """Record where a resolution was served from."""
+        self.counters[outcome] += 1
+
+
+# Global instance
+slug_cache = SlugCache(
+    maxsize=settings.SLUG_LOCAL_CACHE_SIZE,
+    ttl=settings.SLUG_LOCAL_CACHE_TTL,
+    neg_ttl=settings.SLUG_NEG_CACHE_TTL,
+)
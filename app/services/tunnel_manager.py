@@ -1,16 +1,35 @@
 import asyncio
+import logging
+import time
 from dataclasses import dataclass, field
-from typing import Dict, Optional
+from typing import Dict, Optional, Set
 from fastapi import WebSocket
+from app.core.codec import Codec, JSON_CODEC
+from app.core.config import MAX_WS_PAYLOAD
 from app.services.tunnel_registry import tunnel_registry
 
+logger = logging.getLogger(__name__)
 
-@dataclass
+# Lock stripes for register/remove; power of two so the index is a mask
+_LOCK_STRIPES = 64
+
+
+class TunnelClosed(ConnectionError):
+    """The tunnel went away before answering a forwarded request."""
+
+
+@dataclass(slots=True)
 class Tunnel:
     tunnel_id: str  # Phase 4: Use tunnel_id instead of slug
     websocket: WebSocket
-    last_pong: float = field(default_factory=lambda: asyncio.get_event_loop().time())
-    heartbeat_task: Optional[asyncio.Task] = None
+    codec: Codec = JSON_CODEC
+    last_pong: float = field(default_factory=time.monotonic)
+    out_queue: asyncio.Queue = field(default_factory=asyncio.Queue)
+    writer_task: Optional[asyncio.Task] = None
+    # Set once the writer can no longer send; enqueue then refuses frames
+    closed: bool = False
+    # request_ids forwarded on this tunnel and not answered yet
+    pending: Set[str] = field(default_factory=set)
 
 
 class TunnelManager:
@@ -26,56 +45,165 @@ class TunnelManager:
     def __init__(self):
         self.active_tunnels: Dict[str, Tunnel] = {}  # tunnel_id -> Tunnel
         self.pending_requests: Dict[str, asyncio.Future] = {}
-        self._lock = asyncio.Lock()
+        # Disjoint tunnel_ids rarely share a stripe, so they do not serialize
+        self._locks = [asyncio.Lock() for _ in range(_LOCK_STRIPES)]
+        # tunnel_ids whose Redis registration is in flight
+        self._registering: Set[str] = set()
+        # tunnel_ids whose Redis removal is in flight; set when it completes
+        self._removing: Dict[str, asyncio.Event] = {}
 
-    async def register_tunnel(self, tunnel_id: str, websocket: WebSocket) -> Tunnel:
+    async def register_tunnel(
+        self, tunnel_id: str, websocket: WebSocket, codec: Codec = JSON_CODEC
+    ) -> Tunnel:
         """Register tunnel locally and in Redis using tunnel_id."""
-        async with self._lock:
-            # Register in Redis first
+        # Reserve the id locally; the lock is never held across Redis I/O.
+        # A reconnect racing its own disconnect waits for the Redis removal,
+        # or SET NX would fail as if another pod owned the tunnel.
+        while True:
+            removing = self._removing.get(tunnel_id)
+            if removing is not None:
+                await removing.wait()
+                continue
+            async with self._lock_for(tunnel_id):
+                if tunnel_id in self._removing:
+                    continue
+                if tunnel_id in self.active_tunnels or tunnel_id in self._registering:
+                    raise ValueError(f"Tunnel {tunnel_id} already registered on this pod")
+                self._registering.add(tunnel_id)
+                break
+
+        try:
             registered = await tunnel_registry.register_tunnel(tunnel_id)
-            if not registered:
-                raise ValueError(f"Tunnel {tunnel_id} already registered on another pod")
-            
-            # Store locally
-            tunnel = Tunnel(tunnel_id=tunnel_id, websocket=websocket)
+        except BaseException:
+            self._registering.discard(tunnel_id)
+            raise
+        if not registered:
+            self._registering.discard(tunnel_id)
+            raise ValueError(f"Tunnel {tunnel_id} already registered on another pod")
+
+        async with self._lock_for(tunnel_id):
+            self._registering.discard(tunnel_id)
+            tunnel = Tunnel(tunnel_id=tunnel_id, websocket=websocket, codec=codec)
+            tunnel.writer_task = asyncio.create_task(self._writer_loop(tunnel))
             self.active_tunnels[tunnel_id] = tunnel
             return tunnel
 
+    def _lock_for(self, tunnel_id: str) -> asyncio.Lock:
+        """Lock stripe guarding tunnel_id's local state."""
+        return self._locks[hash(tunnel_id) & (_LOCK_STRIPES - 1)]
+
     async def remove_tunnel(self, tunnel_id: str):
         """Remove tunnel from local state and Redis."""
-        async with self._lock:
+        done: Optional[asyncio.Event] = None
+        async with self._lock_for(tunnel_id):
             tunnel = self.active_tunnels.pop(tunnel_id, None)
-            if tunnel and tunnel.heartbeat_task:
-                tunnel.heartbeat_task.cancel()
-            
-            # Remove from Redis
+            if tunnel:
+                if tunnel.writer_task:
+                    tunnel.writer_task.cancel()
+                self._close(tunnel)
+                # Keep the id reserved until Redis no longer maps it to us
+                done = self._removing[tunnel_id] = asyncio.Event()
+
+        # Remove from Redis
+        try:
             await tunnel_registry.remove_tunnel(tunnel_id)
+        finally:
+            if done is not None:
+                del self._removing[tunnel_id]
+                done.set()
 
-    def get_tunnel(self, tunnel_id: str) -> Optional[WebSocket]:
-        """Get local tunnel websocket if exists."""
+    def get_tunnel(self, tunnel_id: str) -> Optional[Tunnel]:
+        """Get local tunnel if exists."""
+        return self.active_tunnels.get(tunnel_id)
+
+    def enqueue(self, tunnel_id: str, frame: bytes) -> bool:
+        """
+        Queue a serialized frame for the tunnel's writer task.
+
+        Returns False if the tunnel is not connected to this pod.
+        """
         t = self.active_tunnels.get(tunnel_id)
-        return t.websocket if t else None
+        if not t or t.closed:
+            return False
+        t.out_queue.put_nowait(frame)
+        return True
+
+    def _close(self, tunnel: Tunnel):
+        """Stop accepting frames for tunnel and fail its unanswered requests."""
+        tunnel.closed = True
+        for request_id in tuple(tunnel.pending):
+            future = self.pending_requests.pop(request_id, None)
+            if future and not future.done():
+                future.set_exception(TunnelClosed(tunnel.tunnel_id))
+        tunnel.pending.clear()
+
+    async def _writer_loop(self, tunnel: Tunnel):
+        """
+        Single writer per tunnel. Frames queued while a send is in flight
+        are coalesced into one batch message, up to MAX_WS_PAYLOAD_BYTES.
+        """
+        queue = tunnel.out_queue
+        codec = tunnel.codec
+        limit = MAX_WS_PAYLOAD
+        carry: Optional[bytes] = None
+        while True:
+            first = carry if carry is not None else await queue.get()
+            carry = None
+            frames = [first]
+            size = codec.batch_overhead + len(first)
+            while not queue.empty():
+                frame = queue.get_nowait()
+                if size + len(frame) + 1 > limit:
+                    carry = frame
+                    break
+                frames.append(frame)
+                size += len(frame) + 1
+
+            message = frames[0] if len(frames) == 1 else codec.batch(frames)
+            try:
+                await tunnel.websocket.send_bytes(message)
+            except Exception:
+                logger.warning("Failed to write to tunnel, closing", extra={"tunnel_id": tunnel.tunnel_id})
+                # Later requests get a prompt 502 instead of waiting out the timeout
+                self._close(tunnel)
+                try:
+                    await tunnel.websocket.close()
+                except Exception:
+                    pass
+                return
 
     async def get_tunnel_pod(self, tunnel_id: str) -> Optional[str]:
         """Query Redis to find which pod owns this tunnel."""
         return await tunnel_registry.get_tunnel_pod(tunnel_id)
 
-    def create_pending_request(self, request_id: str) -> asyncio.Future:
-        loop = asyncio.get_event_loop()
+    def create_pending_request(self, request_id: str, tunnel: Tunnel) -> asyncio.Future:
+        """
+        Bare future keyed by request_id; callers await it directly, no Task.
+        Fails with TunnelClosed if tunnel goes away before answering.
+        """
+        loop = asyncio.get_running_loop()
         future = loop.create_future()
         self.pending_requests[request_id] = future
+        tunnel.pending.add(request_id)
+        future.add_done_callback(lambda _: tunnel.pending.discard(request_id))
         return future
 
+    def cancel_pending_request(self, request_id: str):
+        """Forget a request that will not be answered (send failed or timed out)."""
+        future = self.pending_requests.pop(request_id, None)
+        if future and not future.done():
+            future.cancel()
+
     def resolve_request(self, request_id: str, data):
         future = self.pending_requests.pop(request_id, None)
         if future and not future.done():
             future.set_result(data)
 
     def set_pong(self, tunnel_id: str):
-        """Update last pong time for tunnel."""
+        """Record an app-level pong from agents that still send them."""
         t = self.active_tunnels.get(tunnel_id)
         if t:
-            t.last_pong = asyncio.get_event_loop().time()
+            t.last_pong = time.monotonic()
 
 
 tunnel_manager = TunnelManager()
@@ -7,14 +7,73 @@ Stores mappings:
 
 Phase 4: Slug cache for Control Plane resolution
 - slug:{slug} -> tunnel_id (with TTL)
+- slug:neg:{slug} -> "1" for slugs the Control Plane 404'd (short TTL)
+- stats:slug_cache:miss -> count of Control Plane fetches
+
+Concurrent slug lookups are coalesced: callers arriving within
+SLUG_BATCH_WINDOW_MS share one MGET round-trip.
+
+With SLUG_CLIENT_TRACKING, Redis pushes invalidations for slug:* keys
+(CLIENT TRACKING BCAST) so in-process slug caches drop entries as soon
+as they change, expire or are evicted, instead of waiting out their TTL.
 """
+import asyncio
 import logging
-from typing import Optional
+import socket
+from typing import Awaitable, Callable, Dict, List, Optional, Tuple, Union
 import redis.asyncio as redis
+from redis.asyncio.connection import Connection
+from redis.client import NEVER_DECODE
+from redis.commands.core import AsyncScript
 from app.core.config import settings
 
 logger = logging.getLogger(__name__)
 
+# Returned by slug lookups when the slug is negatively cached
+SLUG_NOT_FOUND = object()
+
+# TCP keepalive: probe after 30s idle, every 10s, give up after 3 misses.
+# Only the options this platform supports (TCP_KEEPIDLE is Linux-only).
+_KEEPALIVE_OPTIONS = {
+    getattr(socket, name): value
+    for name, value in (("TCP_KEEPIDLE", 30), ("TCP_KEEPINTVL", 10), ("TCP_KEEPCNT", 3))
+    if hasattr(socket, name)
+}
+
+_SLUG_PREFIX = "slug:"
+_SLUG_NEG_PREFIX = "slug:neg:"
+_INVALIDATE_CHANNEL = "__redis__:invalidate"
+
+# Pod-shared counter of slug lookups that fell through to the Control Plane
+_SLUG_MISS_KEY = "stats:slug_cache:miss"
+_STATS_TTL = 3600
+
+# The scripts touch a tunnel key and a pod set, which hash to different slots,
+# so they need a single Redis node (or a proxy that does not split keys); they
+# are not Redis Cluster safe.
+
+# Claim KEYS[1] for pod ARGV[1] (TTL ARGV[2]) and add ARGV[3] to the pod set
+# KEYS[2], atomically and in one round-trip. Returns 1 if claimed.
+_REGISTER_LUA = """
+if redis.call('SET', KEYS[1], ARGV[1], 'NX', 'EX', ARGV[2]) then
+    redis.call('SADD', KEYS[2], ARGV[3])
+    return 1
+end
+return 0
+"""
+
+# Remove ARGV[1] from the pod set KEYS[2], and drop KEYS[1] only if it still
+# belongs to pod ARGV[2]: after a TTL lapse another pod may have claimed it.
+# Returns 1 if the tunnel key was deleted.
+_REMOVE_LUA = """
+redis.call('SREM', KEYS[2], ARGV[1])
+if redis.call('GET', KEYS[1]) == ARGV[2] then
+    redis.call('DEL', KEYS[1])
+    return 1
+end
+return 0
+"""
+
 
 class TunnelRegistry:
     """Redis-backed registry tracking which pod owns which tunnel."""
@@ -22,30 +81,136 @@ class TunnelRegistry:
     def __init__(self):
         self._redis: Optional[redis.Redis] = None
         self._pod_id: Optional[str] = None
+        # Pending slug lookups waiting for the next batched MGET
+        self._slug_waiters: Dict[str, asyncio.Future] = {}
+        self._slug_flush_task: Optional[asyncio.Task] = None
+        self._register_script: Optional[AsyncScript] = None
+        self._remove_script: Optional[AsyncScript] = None
+        # Dedicated connections for client-side caching invalidations
+        self._tracking_conns: List[Connection] = []
+        self._tracking_task: Optional[asyncio.Task] = None
 
     async def connect(self, pod_id: str):
         """Initialize Redis connection and set pod_id."""
         self._pod_id = pod_id
-        self._redis = redis.Redis(
+        # Bounded pool (callers wait for a free connection rather than erroring
+        # when it is exhausted); kernel keepalive + periodic PING catch dead
+        # connections before a request stalls on them
+        pool = redis.BlockingConnectionPool(
             host=settings.REDIS_HOST,
             port=settings.REDIS_PORT,
             db=settings.REDIS_DB,
             password=settings.REDIS_PASSWORD,
             decode_responses=True,
+            max_connections=settings.REDIS_MAX_CONNECTIONS,
+            timeout=5,
+            socket_keepalive=True,
+            socket_keepalive_options=_KEEPALIVE_OPTIONS,
+            health_check_interval=settings.REDIS_HEALTH_CHECK_INTERVAL,
         )
+        self._redis = redis.Redis(connection_pool=pool)
         await self._redis.ping()
+        # Scripts run via EVALSHA and are reloaded automatically on NOSCRIPT
+        self._register_script = self._redis.register_script(_REGISTER_LUA)
+        self._remove_script = self._redis.register_script(_REMOVE_LUA)
         logger.info("Redis tunnel registry connected", extra={"pod_id": pod_id})
 
+    async def track_slugs(self, on_invalidate: Callable[[Optional[str]], None]) -> bool:
+        """
+        Subscribe to Redis invalidations for slug:* keys.
+
+        on_invalidate(slug) runs whenever a slug (or its negative entry)
+        changes, expires or is evicted, and with None after a flush.
+        Tracking is BCAST on a dedicated connection, redirected to a
+        second connection subscribed to __redis__:invalidate (RESP2).
+        NOLOOP skips writes made on the tracking connection itself.
+        Returns False if the server rejects tracking; callers then rely
+        on TTLs alone.
+        """
+        if not self._redis:
+            return False
+
+        pool = self._redis.connection_pool
+        listener = pool.make_connection()
+        tracker = pool.make_connection()
+        try:
+            await listener.connect()
+            await listener.send_command("CLIENT", "ID")
+            listener_id = await listener.read_response()
+            await listener.send_command("SUBSCRIBE", _INVALIDATE_CHANNEL)
+            await listener.read_response()
+
+            await tracker.connect()
+            await tracker.send_command(
+                "CLIENT", "TRACKING", "ON", "REDIRECT", listener_id,
+                "BCAST", "PREFIX", _SLUG_PREFIX, "NOLOOP",
+            )
+            await tracker.read_response()
+        except Exception as e:
+            await listener.disconnect()
+            await tracker.disconnect()
+            logger.warning("Redis client tracking unavailable, using TTLs only", extra={"error": str(e)})
+            return False
+
+        self._tracking_conns = [listener, tracker]
+        self._tracking_task = asyncio.create_task(self._read_invalidations(listener, on_invalidate))
+        logger.info("Redis client tracking enabled for slugs", extra={"pod_id": self._pod_id})
+        return True
+
+    async def _read_invalidations(
+        self, listener: Connection, on_invalidate: Callable[[Optional[str]], None]
+    ):
+        """Forward invalidation messages to on_invalidate until the connection drops."""
+        try:
+            while True:
+                # ["message", "__redis__:invalidate", [keys] | None]
+                message = await listener.read_response()
+                if not isinstance(message, list) or message[0] != "message":
+                    continue
+                keys = message[2]
+                if keys is None:
+                    on_invalidate(None)
+                    continue
+                for key in keys:
+                    if key.startswith(_SLUG_NEG_PREFIX):
+                        on_invalidate(key[len(_SLUG_NEG_PREFIX):])
+                    else:
+                        on_invalidate(key[len(_SLUG_PREFIX):])
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            # Invalidations may have been missed; drop everything and fall back to TTLs
+            logger.warning("Redis invalidation stream lost", extra={"error": str(e)})
+            on_invalidate(None)
+
     async def disconnect(self):
         """Close Redis connection and cleanup pod tunnels."""
+        if self._tracking_task:
+            # Let the reader unwind before its connection is torn down
+            self._tracking_task.cancel()
+            try:
+                await self._tracking_task
+            except asyncio.CancelledError:
+                pass
+            self._tracking_task = None
+        for conn in self._tracking_conns:
+            await conn.disconnect()
+        self._tracking_conns = []
+
         if self._redis and self._pod_id:
             # Remove all tunnels for this pod
-            tunnel_ids = await self._redis.smembers(f"pod:{self._pod_id}:tunnels")
+            pod_key = f"pod:{self._pod_id}:tunnels"
+            tunnel_ids = await self._redis.smembers(pod_key)
             if tunnel_ids:
+                # Same ownership check as remove_tunnel, batched in one pipeline
                 pipeline = self._redis.pipeline()
                 for tunnel_id in tunnel_ids:
-                    pipeline.delete(f"tunnel:{tunnel_id}")
-                pipeline.delete(f"pod:{self._pod_id}:tunnels")
+                    await self._remove_script(
+                        keys=[f"tunnel:{tunnel_id}", pod_key],
+                        args=[tunnel_id, self._pod_id],
+                        client=pipeline,
+                    )
+                pipeline.delete(pod_key)
                 await pipeline.execute()
                 logger.info("Cleaned up pod tunnels", extra={"pod_id": self._pod_id, "count": len(tunnel_ids)})
             
@@ -60,18 +225,14 @@ class TunnelRegistry:
         if not self._redis or not self._pod_id:
             raise RuntimeError("TunnelRegistry not connected")
 
-        # Use SET NX (only set if doesn't exist) for atomic registration
+        # SET NX (only set if doesn't exist) + SADD, atomic on the server
         tunnel_key = f"tunnel:{tunnel_id}"
-        was_set = await self._redis.set(
-            tunnel_key,
-            self._pod_id,
-            nx=True,
-            ex=settings.TUNNEL_REGISTRY_TTL,
+        was_set = await self._register_script(
+            keys=[tunnel_key, f"pod:{self._pod_id}:tunnels"],
+            args=[self._pod_id, settings.TUNNEL_REGISTRY_TTL, tunnel_id],
         )
 
         if was_set:
-            # Add to pod's tunnel set
-            await self._redis.sadd(f"pod:{self._pod_id}:tunnels", tunnel_id)
             logger.info("Tunnel registered", extra={"tunnel_id": tunnel_id, "pod_id": self._pod_id})
             return True
         else:
@@ -87,10 +248,10 @@ class TunnelRegistry:
         if not self._redis or not self._pod_id:
             return
 
-        pipeline = self._redis.pipeline()
-        pipeline.delete(f"tunnel:{tunnel_id}")
-        pipeline.srem(f"pod:{self._pod_id}:tunnels", tunnel_id)
-        await pipeline.execute()
+        await self._remove_script(
+            keys=[f"tunnel:{tunnel_id}", f"pod:{self._pod_id}:tunnels"],
+            args=[tunnel_id, self._pod_id],
+        )
         logger.info("Tunnel unregistered", extra={"tunnel_id": tunnel_id, "pod_id": self._pod_id})
 
     async def get_tunnel_pod(self, tunnel_id: str) -> Optional[str]:
@@ -111,28 +272,103 @@ class TunnelRegistry:
         return self._pod_id
 
     # Phase 4: Slug cache methods
-    async def cache_slug_resolution(self, slug: str, tunnel_id: str):
-        """Cache slug -> tunnel_id mapping with TTL."""
+    async def try_cache_then_resolve(
+        self, slug: str, fetch: Callable[[], Awaitable[Optional[dict]]]
+    ) -> Tuple[Union[str, object, None], Optional[dict]]:
+        """
+        Look slug up in Redis, falling back to fetch() (the Control Plane).
+
+        Returns (cached, None) on a Redis hit, where cached is a tunnel_id
+        or SLUG_NOT_FOUND, and (None, fetch_result) on a miss. Miss-path
+        writes (slug or negative key plus the miss counter) go out in one
+        pipeline; stale results are not written back.
+        """
+        cached = await self.get_cached_slug(slug)
+        if cached:
+            return cached, None
+
+        result = await fetch()
         if not self._redis:
-            return
-        
-        await self._redis.set(
-            f"slug:{slug}",
-            tunnel_id,
-            ex=settings.SLUG_CACHE_TTL,
-        )
-        logger.debug("Slug cached", extra={"slug": slug, "tunnel_id": tunnel_id})
+            return None, result
 
-    async def get_cached_slug(self, slug: str) -> Optional[str]:
-        """Get cached tunnel_id for slug."""
+        pipeline = self._redis.pipeline()
+        # Stale (served during a CP outage) results must not get a fresh TTL
+        status = result.get("status") if result and not result.get("stale") else None
+        if status == "active":
+            pipeline.set(f"slug:{slug}", result["tunnel_id"], ex=settings.SLUG_CACHE_TTL)
+        elif status == "not_found":
+            pipeline.set(f"slug:neg:{slug}", "1", ex=settings.SLUG_NEG_CACHE_TTL)
+        pipeline.incr(_SLUG_MISS_KEY)
+        pipeline.expire(_SLUG_MISS_KEY, _STATS_TTL)
+        await pipeline.execute()
+        logger.debug("Slug resolved via Control Plane", extra={"slug": slug})
+        return None, result
+
+    async def get_cached_slug(self, slug: str) -> Union[str, object, None]:
+        """
+        Get cached tunnel_id for slug, or SLUG_NOT_FOUND if negatively cached.
+
+        Lookups are queued for up to SLUG_BATCH_WINDOW_MS and resolved
+        together by a single MGET; concurrent callers for the same slug
+        share one future.
+        """
         if not self._redis:
             return None
-        
-        tunnel_id = await self._redis.get(f"slug:{slug}")
-        if tunnel_id:
+
+        fut = self._slug_waiters.get(slug)
+        if fut is None:
+            fut = asyncio.get_running_loop().create_future()
+            self._slug_waiters[slug] = fut
+            if self._slug_flush_task is None:
+                self._slug_flush_task = asyncio.create_task(self._flush_slug_lookups())
+
+        # Shield so one cancelled caller does not cancel the shared future
+        tunnel_id = await asyncio.shield(fut)
+        if tunnel_id and tunnel_id is not SLUG_NOT_FOUND:
             logger.debug("Slug cache hit", extra={"slug": slug, "tunnel_id": tunnel_id})
         return tunnel_id
 
+    async def mget_cached_slugs(self, slugs: List[str]) -> List[Union[str, object, None]]:
+        """
+        Get cached tunnel_ids for several slugs in one round-trip.
+
+        Positive and negative keys are fetched together; a negatively
+        cached slug comes back as SLUG_NOT_FOUND. The reply is read as raw
+        bytes and only positive hits are decoded, once, into str.
+        """
+        if not self._redis:
+            return [None] * len(slugs)
+
+        keys = []
+        for slug in slugs:
+            keys.append(f"{_SLUG_PREFIX}{slug}")
+            keys.append(f"{_SLUG_NEG_PREFIX}{slug}")
+        values = await self._redis.execute_command("MGET", *keys, **{NEVER_DECODE: True})
+        return [
+            tunnel_id.decode() if tunnel_id else (SLUG_NOT_FOUND if neg else None)
+            for tunnel_id, neg in zip(values[::2], values[1::2])
+        ]
+
+    async def _flush_slug_lookups(self):
+        """Resolve every slug lookup queued during the batch window."""
+        await asyncio.sleep(settings.SLUG_BATCH_WINDOW_MS / 1000)
+        waiters, self._slug_waiters = self._slug_waiters, {}
+        self._slug_flush_task = None
+
+        slugs = list(waiters)
+        try:
+            tunnel_ids = await self.mget_cached_slugs(slugs)
+        except Exception as e:
+            for fut in waiters.values():
+                if not fut.done():
+                    fut.set_exception(e)
+            return
+
+        for slug, tunnel_id in zip(slugs, tunnel_ids):
+            fut = waiters[slug]
+            if not fut.done():
+                fut.set_result(tunnel_id)
+
 
 # Global instance
 tunnel_registry = TunnelRegistry()
@@ -5,28 +5,40 @@ This simulates the Control Plane API that Edge gateway calls
 to resolve slugs to tunnel IDs and validate tunnel tokens.
 
 Run with: python mock_control_plane.py
+(set MOCK_CP_WORKERS=4 for load tests)
 """
 from fastapi import FastAPI, HTTPException
+from fastapi.responses import ORJSONResponse
 from pydantic import BaseModel
 from datetime import datetime, timedelta
+import os
+import time
 import uvicorn
 
-app = FastAPI(title="Mock Control Plane")
+app = FastAPI(title="Mock Control Plane", default_response_class=ORJSONResponse)
+
+_EPOCH = datetime(1970, 1, 1)
+
+
+def _expires(delta: timedelta) -> dict:
+    """Expiry as epoch seconds, plus the ISO string kept during the transition."""
+    dt = datetime.utcnow() + delta
+    return {"expires_at": int((dt - _EPOCH).total_seconds()), "expires_at_iso": dt.isoformat()}
 
 SLUG_DATABASE = {
     "my-slug": {
         "tunnel_id": "tunnel_test123",
-        "expires_at": (datetime.utcnow() + timedelta(hours=24)).isoformat(),
+        **_expires(timedelta(hours=24)),
         "status": "active"
     },
     "test-slug": {
         "tunnel_id": "tunnel_abc456",
-        "expires_at": (datetime.utcnow() + timedelta(hours=1)).isoformat(),
+        **_expires(timedelta(hours=1)),
         "status": "active"
     },
     "expired-slug": {
         "tunnel_id": "tunnel_expired",
-        "expires_at": (datetime.utcnow() - timedelta(hours=1)).isoformat(),
+        **_expires(timedelta(hours=-1)),
         "status": "expired"
     },
 }
@@ -36,27 +48,32 @@ SLUG_DATABASE = {
 TUNNEL_TOKENS = {
     "tunnel_test123": {
         "token": "valid_token_123",
-        "expires_at": (datetime.utcnow() + timedelta(hours=24)).isoformat(),
+        **_expires(timedelta(hours=24)),
         "status": "active"
     },
     "tunnel_abc456": {
         "token": "valid_token_456",
-        "expires_at": (datetime.utcnow() + timedelta(hours=1)).isoformat(),
+        **_expires(timedelta(hours=1)),
         "status": "active"
     },
     "tunnel_expired": {
         "token": "expired_token",
-        "expires_at": (datetime.utcnow() - timedelta(hours=1)).isoformat(),
+        **_expires(timedelta(hours=-1)),
         "status": "expired"
     },
     "tunnel_revoked": {
         "token": "revoked_token",
-        "expires_at": (datetime.utcnow() + timedelta(hours=1)).isoformat(),
+        **_expires(timedelta(hours=1)),
         "status": "revoked"
     },
 }
 
 
+# Number of validate calls served, so tests can see whether the Edge
+# reused a cached validation instead of calling us
+STATS = {"validations": 0}
+
+
 class ValidateTunnelRequest(BaseModel):
     tunnel_id: str
     token: str
@@ -68,7 +85,7 @@ async def resolve_slug(slug: str):
     Resolve slug to tunnel metadata.
     
     Returns:
-        200: {tunnel_id, expires_at, status}
+        200: {tunnel_id, expires_at (epoch seconds), expires_at_iso, status}
         404: Slug not found
     """
     tunnel_info = SLUG_DATABASE.get(slug)
@@ -87,10 +104,11 @@ async def validate_tunnel(request: ValidateTunnelRequest):
     Checks if the provided tunnel_id and token are valid and active.
     
     Returns:
-        200: {valid: true, tunnel_id, status, expires_at}
+        200: {valid: true, tunnel_id, status, expires_at (epoch seconds), expires_at_iso}
         401: Invalid token
         404: Tunnel not found
     """
+    STATS["validations"] += 1
     tunnel_info = TUNNEL_TOKENS.get(request.tunnel_id)
     
     if not tunnel_info:
@@ -105,17 +123,24 @@ async def validate_tunnel(request: ValidateTunnelRequest):
     expires_at = tunnel_info["expires_at"]
     
     # Check if expired (even if status says active)
-    if datetime.fromisoformat(expires_at) < datetime.utcnow():
+    if expires_at < time.time():
         status = "expired"
     
     return {
         "valid": status == "active",
         "tunnel_id": request.tunnel_id,
         "status": status,
-        "expires_at": expires_at
+        "expires_at": expires_at,
+        "expires_at_iso": tunnel_info["expires_at_iso"],
     }
 
 
+@app.get("/api/stats/validations")
+async def validation_stats():
+    """Validate calls served by this worker process."""
+    return STATS
+
+
 @app.get("/health")
 async def health():
     return {"status": "ok"}
@@ -133,4 +158,14 @@ if __name__ == "__main__":
         print(f"    Status: {info['status']}")
     print()
     
-    uvicorn.run(app, host="0.0.0.0", port=8000)
+    # uvloop + httptools so the mock is not the bottleneck when load testing
+    # the Edge. MOCK_CP_WORKERS > 1 forks processes; each has its own state.
+    uvicorn.run(
+        "mock_control_plane:app",
+        host="0.0.0.0",
+        port=8000,
+        loop="uvloop",
+        http="httptools",
+        workers=int(os.environ.get("MOCK_CP_WORKERS", "1")),
+        log_level="warning",
+    )
@@ -0,0 +1,209 @@
+"""
+Shared helpers for the Phase 5 test and verification scripts.
+"""
+import asyncio
+import importlib
+import os
+import socket
+import time
+from typing import Awaitable, Callable, Dict, List, Optional, Union
+import httpx
+import orjson
+import websockets
+from websockets.asyncio.client import ClientConnection
+from websockets.frames import Frame, Opcode
+
+try:
+    import uvloop
+except ImportError:  # uvloop has no Windows build
+    uvloop = None
+
+_CLIENT: Optional[httpx.AsyncClient] = None
+
+# The Edge writes envelopes with orjson, type first, so frames can be
+# dispatched on their leading bytes without decoding them
+PING = b'{"type":"ping"}'
+PONG_PREFIX = b'{"type":"pong"'
+REQUEST_PREFIX = b'{"type":"request"'
+
+# (epoch second, formatted) of the last ts() call
+_ts_cache = [0, ""]
+
+
+def _loop_factory() -> Optional[Callable[[], asyncio.AbstractEventLoop]]:
+    """
+    Event loop for the scripts, chosen by PHASE5_LOOP:
+    - unset / "auto": uvloop when installed, else asyncio's default loop
+    - "asyncio": asyncio's default loop
+    - "uvloop": uvloop, failing if it is missing
+    - "module:callable": any other loop factory, e.g. an io_uring-backed loop
+    """
+    choice = os.environ.get("PHASE5_LOOP", "auto")
+    if choice == "auto":
+        return uvloop.new_event_loop if uvloop is not None else None
+    if choice == "asyncio":
+        return None
+    if choice == "uvloop":
+        if uvloop is None:
+            raise RuntimeError("PHASE5_LOOP=uvloop but uvloop is not installed")
+        return uvloop.new_event_loop
+    module, _, attr = choice.partition(":")
+    if not attr:
+        raise RuntimeError(f"PHASE5_LOOP must be auto, asyncio, uvloop or module:callable, got {choice!r}")
+    return getattr(importlib.import_module(module), attr)
+
+
+def run(main: Callable[[], Awaitable[int]]) -> int:
+    """
+    Run main() on the loop selected by PHASE5_LOOP, then close the shared
+    HTTP client, so it is kept alive across everything main() runs.
+    """
+    async def _main() -> int:
+        try:
+            return await main()
+        finally:
+            await close_client()
+
+    with asyncio.Runner(loop_factory=_loop_factory()) as runner:
+        return runner.run(_main())
+
+
+def ts() -> str:
+    """Wall-clock HH:MM:SS for log lines, formatted at most once per second."""
+    now = int(time.time())
+    if now != _ts_cache[0]:
+        _ts_cache[0] = now
+        _ts_cache[1] = time.strftime("%H:%M:%S", time.localtime(now))
+    return _ts_cache[1]
+
+
+def frame_startswith(raw: Union[bytes, str], prefix: bytes) -> bool:
+    """Whether a received frame (text or binary) begins with prefix."""
+    if isinstance(raw, str):
+        raw = raw.encode()
+    return raw.startswith(prefix)
+
+
+async def get_client() -> httpx.AsyncClient:
+    """Process-wide HTTP client, so connections are kept alive between calls."""
+    global _CLIENT
+    if _CLIENT is None:
+        _CLIENT = httpx.AsyncClient(
+            limits=httpx.Limits(max_keepalive_connections=20, keepalive_expiry=30.0),
+            timeout=10.0,
+        )
+    return _CLIENT
+
+
+async def close_client():
+    """Close the shared HTTP client (run() does this after main)."""
+    global _CLIENT
+    if _CLIENT is not None:
+        await _CLIENT.aclose()
+        _CLIENT = None
+
+
+class NoDelayConnection(ClientConnection):
+    """
+    Agent connection with Nagle disabled and delayed ACKs off, so small
+    ping/pong and response frames are not held back by the TCP stack.
+
+    server_ping is set whenever the Edge sends a native PING (websockets
+    answers it with a PONG itself), so tests can prove server keepalive runs.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.server_ping = asyncio.Event()
+
+    def process_event(self, event):
+        super().process_event(event)
+        if isinstance(event, Frame) and event.opcode is Opcode.PING:
+            self.server_ping.set()
+
+    def connection_made(self, transport: asyncio.BaseTransport):
+        super().connection_made(transport)
+        sock = transport.get_extra_info("socket")
+        if sock is None:
+            return
+        # asyncio already sets TCP_NODELAY; set it again in case of a custom loop
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        if hasattr(socket, "TCP_QUICKACK"):
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_QUICKACK, 1)
+
+
+# Test frames are small JSON envelopes: deflate costs CPU and saves nothing,
+# and the Edge already keeps agents alive with its own native pings
+_WS_DEFAULTS = {
+    "compression": None,
+    "max_size": 2**16,
+    "write_limit": 2**16,
+    "ping_interval": None,
+}
+
+
+def ws_connect(url: str, **kwargs) -> websockets.connect:
+    """
+    websockets.connect with NoDelayConnection and _WS_DEFAULTS (overridable
+    per call); usable with await or async with.
+    """
+    return websockets.connect(
+        url, create_connection=NoDelayConnection, **{**_WS_DEFAULTS, **kwargs}
+    )
+
+
+async def make_pool(ws_url: str, tunnels: Dict[str, str]) -> Dict[str, ClientConnection]:
+    """
+    Open one authenticated agent WebSocket per tunnel_id -> token.
+
+    The Edge accepts a single connection per tunnel_id, so the "pool" is
+    one connection per tunnel, shared by every positive-path test.
+    """
+    pool = {}
+    for tunnel_id, token in tunnels.items():
+        pool[tunnel_id] = await ws_connect(
+            f"{ws_url}/ws/{tunnel_id}",
+            additional_headers={"X-Tunnel-Token": token}
+        )
+    return pool
+
+
+async def close_pool(pool: Dict[str, ClientConnection]):
+    """Close every connection opened by make_pool."""
+    for ws in pool.values():
+        await ws.close()
+
+
+class BatchedWS:
+    """
+    Coalesces frames sent within one event-loop tick into a single
+    `batch` frame, which the Edge unpacks like any other agent message.
+    """
+
+    def __init__(self, ws: ClientConnection):
+        self.ws = ws
+        self.queue: List[bytes] = []
+        self.flush_task: Optional[asyncio.Task] = None
+
+    async def send(self, obj: Union[dict, bytes]):
+        """
+        Queue obj (a dict, or an already-encoded JSON frame); it is written
+        after the current tick yields.
+        """
+        self.queue.append(obj if isinstance(obj, bytes) else orjson.dumps(obj))
+        if self.flush_task is None:
+            self.flush_task = asyncio.create_task(self._flush())
+
+    async def flush(self):
+        """Wait until every queued frame has been written."""
+        if self.flush_task is not None:
+            await self.flush_task
+
+    async def _flush(self):
+        await asyncio.sleep(0)
+        frames, self.queue = self.queue, []
+        self.flush_task = None
+        if len(frames) == 1:
+            await self.ws.send(frames[0])
+        else:
+            await self.ws.send(b'{"type":"batch","items":[' + b",".join(frames) + b"]}")
@@ -0,0 +1,21 @@
+#!/usr/bin/env python3
+"""
+Run the Phase 5 integration tests and capability verification in one
+process, sharing imports, the event loop and the keep-alive HTTP client.
+
+Prerequisites: the same as test_phase5.py and verify_phase5.py.
+"""
+from phase5_common import run
+from test_phase5 import main as run_tests
+from verify_phase5 import main as run_verify
+
+
+async def main():
+    tests_rc = await run_tests()
+    verify_rc = await run_verify()
+    return tests_rc | verify_rc
+
+
+if __name__ == "__main__":
+    exit_code = run(main)
+    exit(exit_code)
@@ -0,0 +1,78 @@
+#!/usr/bin/env python3
+"""
+Unit tests for ControlPlaneClient coalescing and stale fallback (no services needed).
+
+Run with: python -m unittest test_control_plane_client
+"""
+import asyncio
+import unittest
+import httpx
+from app.services.control_plane_client import ControlPlaneClient
+
+
+class SingleFlightTest(unittest.IsolatedAsyncioTestCase):
+    async def test_waiter_gets_result_when_leader_is_cancelled(self):
+        client = ControlPlaneClient()
+        calls = 0
+        release = asyncio.Event()
+
+        async def fetch():
+            nonlocal calls
+            calls += 1
+            await release.wait()
+            return {"tunnel_id": "tunnel_test123", "status": "active"}
+
+        leader = asyncio.create_task(client._single_flight("k", fetch))
+        await asyncio.sleep(0)
+        waiter = asyncio.create_task(client._single_flight("k", fetch))
+        await asyncio.sleep(0)
+
+        leader.cancel()
+        await asyncio.sleep(0)
+        release.set()
+
+        self.assertEqual((await waiter)["tunnel_id"], "tunnel_test123")
+        with self.assertRaises(asyncio.CancelledError):
+            await leader
+        self.assertEqual(calls, 1)
+        self.assertEqual(client._inflight, {})
+
+    async def test_waiters_get_the_real_error(self):
+        client = ControlPlaneClient()
+
+        async def fetch():
+            await asyncio.sleep(0)
+            raise RuntimeError("ControlPlaneClient not connected")
+
+        results = await asyncio.gather(
+            *(client._single_flight("k", fetch) for _ in range(3)),
+            return_exceptions=True,
+        )
+        self.assertTrue(all(isinstance(r, RuntimeError) for r in results))
+        self.assertEqual(client._inflight, {})
+
+
+class StaleSlugTest(unittest.IsolatedAsyncioTestCase):
+    async def test_cp_outage_serves_last_good_result_marked_stale(self):
+        client = ControlPlaneClient()
+        client._client = object()  # only checked for "connected"
+        replies = [
+            httpx.Response(200, json={"tunnel_id": "tunnel_test123", "status": "active"}),
+            httpx.Response(500),
+        ]
+
+        async def request(method, path, **kwargs):
+            return replies.pop(0)
+
+        client._request = request
+        fresh = await client._fetch_slug("demo")
+        stale = await client._fetch_slug("demo")
+
+        self.assertNotIn("stale", fresh)
+        self.assertEqual(stale, {**fresh, "stale": True})
+        # Marking the result does not mark the copy kept for later outages
+        self.assertNotIn("stale", client._stale_slugs["demo"])
+
+
+if __name__ == "__main__":
+    unittest.main()
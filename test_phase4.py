@@ -28,19 +28,24 @@ TUNNEL_ID = "tunnel_test123"
 SLUG = "my-slug"
 
 
+def ts() -> str:
+    """Wall-clock timestamp for log lines."""
+    return datetime.now().strftime('%H:%M:%S')
+
+
 async def test_agent_simulation():
     """Simulates an agent connecting and responding to requests."""
-    print(f"[{datetime.now().strftime('%H:%M:%S')}] 🔌 Agent connecting to {EDGE_WS_URL}/ws/{TUNNEL_ID}")
+    print(f"[{ts()}] 🔌 Agent connecting to {EDGE_WS_URL}/ws/{TUNNEL_ID}")
     
     async with websockets.connect(f"{EDGE_WS_URL}/ws/{TUNNEL_ID}") as ws:
-        print(f"[{datetime.now().strftime('%H:%M:%S')}] ✅ Agent connected (tunnel_id={TUNNEL_ID})")
+        print(f"[{ts()}] ✅ Agent connected (tunnel_id={TUNNEL_ID})")
         
         # Handle one request then close
         msg = await ws.recv()
         data = json.loads(msg)
         
         if data["type"] == "request":
-            print(f"[{datetime.now().strftime('%H:%M:%S')}] 📨 Agent received: {data['method']} {data['path']}")
+            print(f"[{ts()}] 📨 Agent received: {data['method']} {data['path']}")
             
             response = {
                 "type": "response",
@@ -55,7 +60,7 @@ async def test_agent_simulation():
             }
             
             await ws.send(json.dumps(response))
-            print(f"[{datetime.now().strftime('%H:%M:%S')}] 📤 Agent sent response")
+            print(f"[{ts()}] 📤 Agent sent response")
 
 
 async def test_http_request():
@@ -63,13 +68,13 @@ async def test_http_request():
     await asyncio.sleep(1)  # Give agent time to connect
     
     url = f"{EDGE_GATEWAY_URL}/local_tunnel/{SLUG}/api/test"
-    print(f"\n[{datetime.now().strftime('%H:%M:%S')}] 🌐 Making HTTP request to {url}")
+    print(f"\n[{ts()}] 🌐 Making HTTP request to {url}")
     
     async with httpx.AsyncClient() as client:
         response = await client.get(url)
         
-        print(f"[{datetime.now().strftime('%H:%M:%S')}] 📥 Response status: {response.status_code}")
-        print(f"[{datetime.now().strftime('%H:%M:%S')}] 📄 Response body: {response.json()}")
+        print(f"[{ts()}] 📥 Response status: {response.status_code}")
+        print(f"[{ts()}] 📄 Response body: {response.json()}")
         
         if response.status_code == 200:
             print(f"\n✅ Phase 4 test PASSED!")
@@ -81,48 +86,49 @@ async def verify_prerequisites():
     """Verify all required services are running."""
     print("🔍 Verifying prerequisites...\n")
     
+    # One client (and connection pool); the three probes run concurrently
+    async with httpx.AsyncClient() as client:
+        cp_health, edge_health, slug_probe = await asyncio.gather(
+            client.get(f"{CONTROL_PLANE_URL}/health", timeout=2.0),
+            client.get(f"{EDGE_GATEWAY_URL}/health/live", timeout=2.0),
+            client.get(f"{CONTROL_PLANE_URL}/api/tunnels/resolve/{SLUG}", timeout=2.0),
+            return_exceptions=True,
+        )
+
     # Check Control Plane
-    try:
-        async with httpx.AsyncClient() as client:
-            resp = await client.get(f"{CONTROL_PLANE_URL}/health", timeout=2.0)
-            if resp.status_code == 200:
-                print(f"✅ Control Plane running at {CONTROL_PLANE_URL}")
-            else:
-                print(f"❌ Control Plane returned {resp.status_code}")
-                return False
-    except Exception as e:
-        print(f"❌ Control Plane not reachable: {e}")
+    if isinstance(cp_health, Exception):
+        print(f"❌ Control Plane not reachable: {cp_health}")
         print(f"   Start with: python mock_control_plane.py")
         return False
-    
+    if cp_health.status_code == 200:
+        print(f"✅ Control Plane running at {CONTROL_PLANE_URL}")
+    else:
+        print(f"❌ Control Plane returned {cp_health.status_code}")
+        return False
+
     # Check Edge Gateway
-    try:
-        async with httpx.AsyncClient() as client:
-            resp = await client.get(f"{EDGE_GATEWAY_URL}/health/live", timeout=2.0)
-            if resp.status_code == 200:
-                print(f"✅ Edge Gateway running at {EDGE_GATEWAY_URL}")
-            else:
-                print(f"❌ Edge Gateway returned {resp.status_code}")
-                return False
-    except Exception as e:
-        print(f"❌ Edge Gateway not reachable: {e}")
-        print(f"   Start with: uvicorn app.main:app --host 0.0.0.0 --port 8080")
+    if isinstance(edge_health, Exception):
+        print(f"❌ Edge Gateway not reachable: {edge_health}")
+        print(f"   Start with: python -m app.main")
+        print(f"   (or uvicorn app.main:app with the flags listed in CURRENT_STATE.md)")
         return False
-    
+    if edge_health.status_code == 200:
+        print(f"✅ Edge Gateway running at {EDGE_GATEWAY_URL}")
+    else:
+        print(f"❌ Edge Gateway returned {edge_health.status_code}")
+        return False
+
     # Check slug resolution endpoint
-    try:
-        async with httpx.AsyncClient() as client:
-            resp = await client.get(f"{CONTROL_PLANE_URL}/api/tunnels/resolve/{SLUG}", timeout=2.0)
-            if resp.status_code == 200:
-                data = resp.json()
-                print(f"✅ Slug '{SLUG}' resolves to tunnel_id='{data.get('tunnel_id')}'")
-            else:
-                print(f"❌ Slug resolution failed: {resp.status_code}")
-                return False
-    except Exception as e:
-        print(f"❌ Slug resolution error: {e}")
+    if isinstance(slug_probe, Exception):
+        print(f"❌ Slug resolution error: {slug_probe}")
         return False
-    
+    if slug_probe.status_code == 200:
+        data = slug_probe.json()
+        print(f"✅ Slug '{SLUG}' resolves to tunnel_id='{data.get('tunnel_id')}'")
+    else:
+        print(f"❌ Slug resolution failed: {slug_probe.status_code}")
+        return False
+
     print("\n" + "="*60)
     return True
 
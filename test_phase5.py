@@ -15,292 +15,178 @@ Prerequisites:
 - Edge Gateway running on localhost:8080
 """
 import asyncio
-import httpx
-import json
+import orjson
+from typing import Optional
 import websockets
-from datetime import datetime
+from phase5_common import (
+    PING, PONG_PREFIX, REQUEST_PREFIX, BatchedWS, close_pool,
+    frame_startswith, get_client, make_pool, run, ts, ws_connect,
+)
 
 # Test configuration
 CONTROL_PLANE_URL = "http://localhost:8000"  # Keep this for mock CP
 EDGE_GATEWAY_URL = "http://34.0.0.30:8080"   # Your VM IP
 EDGE_WS_URL = "ws://34.0.0.30:8080"          # Your VM IP (ws not wss)
-
-
-async def test_valid_token():
+TUNNEL_ID = "tunnel_test123"
+TOKEN = "valid_token_123"
+SLUG = "my-slug"
+
+# URLs built once instead of per call
+WS_URLS = {
+    tunnel_id: f"{EDGE_WS_URL}/ws/{tunnel_id}"
+    for tunnel_id in (TUNNEL_ID, "tunnel_expired", "tunnel_revoked")
+}
+FULL_FLOW_URL = f"{EDGE_GATEWAY_URL}/local_tunnel/{SLUG}/test"
+
+# Test 6 response with every constant field encoded once; only the
+# JSON-encoded request_id and path are spliced in per request
+_RESP_PREFIX = b'{"type":"response","request_id":'
+_RESP_MID = (
+    b',"status":200,"headers":{"Content-Type":"application/json"},'
+    b'"body":{"message":"Hello from validated agent!","tunnel_id":'
+    + orjson.dumps(TUNNEL_ID) + b',"path":'
+)
+_RESP_SUFFIX = b"}}"
+
+
+async def test_valid_token(ws):
     """Test 1: Agent connects with valid token - should succeed."""
     print(f"\n{'='*60}")
     print("TEST 1: Valid Token Connection")
     print(f"{'='*60}")
     
-    tunnel_id = "tunnel_test123"
-    token = "valid_token_123"
-    
-    print(f"[{datetime.now().strftime('%H:%M:%S')}] 🔌 Attempting connection with valid token...")
-    
-    try:
-        async with websockets.connect(
-            f"{EDGE_WS_URL}/ws/{tunnel_id}",
-            additional_headers={"X-Tunnel-Token": token}
-        ) as ws:
-            print(f"[{datetime.now().strftime('%H:%M:%S')}] ✅ Connection ACCEPTED (as expected)")
-            
-            # Send a ping to verify connection works
-            await ws.send(json.dumps({"type": "ping"}))
-            response = await asyncio.wait_for(ws.recv(), timeout=2)
-            data = json.loads(response)
-            
-            if data["type"] == "pong":
-                print(f"[{datetime.now().strftime('%H:%M:%S')}] ✅ Ping/Pong successful")
-            
-            return True
-    except websockets.exceptions.ConnectionClosedError as e:
-        print(f"[{datetime.now().strftime('%H:%M:%S')}] ❌ Connection REJECTED (unexpected): {e}")
-        return False
-    except Exception as e:
-        print(f"[{datetime.now().strftime('%H:%M:%S')}] ❌ Error: {e}")
-        return False
-
-
-async def test_invalid_token():
-    """Test 2: Agent connects with invalid token - should be rejected."""
-    print(f"\n{'='*60}")
-    print("TEST 2: Invalid Token Connection")
-    print(f"{'='*60}")
-    
-    tunnel_id = "tunnel_test123"
-    token = "wrong_token"
-    
-    print(f"[{datetime.now().strftime('%H:%M:%S')}] 🔌 Attempting connection with invalid token...")
-    
     try:
-        async with websockets.connect(
-            f"{EDGE_WS_URL}/ws/{tunnel_id}",
-            additional_headers={"X-Tunnel-Token": token}
-        ) as ws:
-            # Connection opened, but it should be closed immediately
-            # Try to receive a message - should get ConnectionClosedError
-            try:
-                msg = await asyncio.wait_for(ws.recv(), timeout=1.0)
-                print(f"[{datetime.now().strftime('%H:%M:%S')}] ❌ Connection ACCEPTED (unexpected - should be rejected)")
-                return False
-            except websockets.exceptions.ConnectionClosedError as e:
-                if e.code == 1008:
-                    print(f"[{datetime.now().strftime('%H:%M:%S')}] ✅ Connection REJECTED (as expected): {e.reason}")
-                    return True
-                else:
-                    print(f"[{datetime.now().strftime('%H:%M:%S')}] ⚠️  Connection rejected with unexpected code {e.code}: {e}")
-                    return False
-    except websockets.exceptions.ConnectionClosedError as e:
-        if e.code == 1008:
-            print(f"[{datetime.now().strftime('%H:%M:%S')}] ✅ Connection REJECTED (as expected): {e.reason}")
-            return True
-        else:
-            print(f"[{datetime.now().strftime('%H:%M:%S')}] ⚠️  Connection rejected with unexpected code {e.code}: {e}")
+        if ws is None:
+            print(f"[{ts()}] ❌ Connection REJECTED (unexpected)")
             return False
-    except Exception as e:
-        print(f"[{datetime.now().strftime('%H:%M:%S')}] ⚠️  Unexpected error: {e}")
-        return False
-
-
-async def test_missing_token():
-    """Test 3: Agent connects without token - should be rejected."""
-    print(f"\n{'='*60}")
-    print("TEST 3: Missing Token Connection")
-    print(f"{'='*60}")
-    
-    tunnel_id = "tunnel_test123"
-    
-    print(f"[{datetime.now().strftime('%H:%M:%S')}] 🔌 Attempting connection without token...")
-    
-    try:
-        async with websockets.connect(
-            f"{EDGE_WS_URL}/ws/{tunnel_id}"
-        ) as ws:
-            # Connection opened, but it should be closed immediately
-            try:
-                msg = await asyncio.wait_for(ws.recv(), timeout=1.0)
-                print(f"[{datetime.now().strftime('%H:%M:%S')}] ❌ Connection ACCEPTED (unexpected - should be rejected)")
-                return False
-            except websockets.exceptions.ConnectionClosedError as e:
-                if e.code == 1008:
-                    print(f"[{datetime.now().strftime('%H:%M:%S')}] ✅ Connection REJECTED (as expected): {e.reason}")
-                    return True
-                else:
-                    print(f"[{datetime.now().strftime('%H:%M:%S')}] ⚠️  Connection rejected with unexpected code {e.code}: {e}")
-                    return False
+        print(f"[{ts()}] ✅ Connection ACCEPTED (as expected)")
+        
+        # Send a ping to verify connection works
+        await ws.send(PING)
+        async with asyncio.timeout(2):
+            response = await ws.recv()
+        
+        if frame_startswith(response, PONG_PREFIX):
+            print(f"[{ts()}] ✅ Ping/Pong successful")
+        
+        return True
     except websockets.exceptions.ConnectionClosedError as e:
-        if e.code == 1008:
-            print(f"[{datetime.now().strftime('%H:%M:%S')}] ✅ Connection REJECTED (as expected): {e.reason}")
-            return True
-        else:
-            print(f"[{datetime.now().strftime('%H:%M:%S')}] ⚠️  Connection rejected with unexpected code {e.code}: {e}")
-            return False
+        print(f"[{ts()}] ❌ Connection REJECTED (unexpected): {e}")
+        return False
     except Exception as e:
-        print(f"[{datetime.now().strftime('%H:%M:%S')}] ⚠️  Unexpected error: {e}")
+        print(f"[{ts()}] ❌ Error: {e}")
         return False
 
 
-async def test_expired_tunnel():
-    """Test 4: Agent connects with expired tunnel - should be rejected."""
-    print(f"\n{'='*60}")
-    print("TEST 4: Expired Tunnel Connection")
-    print(f"{'='*60}")
-    
-    tunnel_id = "tunnel_expired"
-    token = "expired_token"
-    
-    print(f"[{datetime.now().strftime('%H:%M:%S')}] 🔌 Attempting connection with expired tunnel...")
-    
-    try:
-        async with websockets.connect(
-            f"{EDGE_WS_URL}/ws/{tunnel_id}",
-            additional_headers={"X-Tunnel-Token": token}
-        ) as ws:
-            # Connection opened, but it should be closed immediately
-            try:
-                msg = await asyncio.wait_for(ws.recv(), timeout=1.0)
-                print(f"[{datetime.now().strftime('%H:%M:%S')}] ❌ Connection ACCEPTED (unexpected - should be rejected)")
-                return False
-            except websockets.exceptions.ConnectionClosedError as e:
-                if e.code == 1008:
-                    print(f"[{datetime.now().strftime('%H:%M:%S')}] ✅ Connection REJECTED (as expected): {e.reason}")
-                    return True
-                else:
-                    print(f"[{datetime.now().strftime('%H:%M:%S')}] ⚠️  Connection rejected with unexpected code {e.code}: {e}")
-                    return False
-    except websockets.exceptions.ConnectionClosedError as e:
-        if e.code == 1008:
-            print(f"[{datetime.now().strftime('%H:%M:%S')}] ✅ Connection REJECTED (as expected): {e.reason}")
-            return True
-        else:
-            print(f"[{datetime.now().strftime('%H:%M:%S')}] ⚠️  Connection rejected with unexpected code {e.code}: {e}")
-            return False
-    except Exception as e:
-        print(f"[{datetime.now().strftime('%H:%M:%S')}] ⚠️  Unexpected error: {e}")
-        return False
+def _is_rejection(e: websockets.exceptions.ConnectionClosedError) -> bool:
+    """Report a close and whether it was the expected 1008 policy violation."""
+    if e.code == 1008:
+        print(f"[{ts()}] ✅ Connection REJECTED (as expected): {e.reason}")
+        return True
+    print(f"[{ts()}] ⚠️  Connection rejected with unexpected code {e.code}: {e}")
+    return False
 
 
-async def test_revoked_tunnel():
-    """Test 5: Agent connects with revoked tunnel - should be rejected."""
+async def expect_rejected(title: str, tunnel_id: str, token: Optional[str]) -> bool:
+    """Tests 2-5: connecting should be rejected with close code 1008."""
     print(f"\n{'='*60}")
-    print("TEST 5: Revoked Tunnel Connection")
+    print(title)
     print(f"{'='*60}")
     
-    tunnel_id = "tunnel_revoked"
-    token = "revoked_token"
+    headers = {"X-Tunnel-Token": token} if token else None
     
-    print(f"[{datetime.now().strftime('%H:%M:%S')}] 🔌 Attempting connection with revoked tunnel...")
+    print(f"[{ts()}] 🔌 Attempting connection to {tunnel_id}...")
     
     try:
-        async with websockets.connect(
-            f"{EDGE_WS_URL}/ws/{tunnel_id}",
-            additional_headers={"X-Tunnel-Token": token}
+        async with ws_connect(
+            WS_URLS[tunnel_id],
+            additional_headers=headers
         ) as ws:
             # Connection opened, but it should be closed immediately
+            # Try to receive a message - should get ConnectionClosedError
             try:
-                msg = await asyncio.wait_for(ws.recv(), timeout=1.0)
-                print(f"[{datetime.now().strftime('%H:%M:%S')}] ❌ Connection ACCEPTED (unexpected - should be rejected)")
+                async with asyncio.timeout(1.0):
+                    await ws.recv()
+                print(f"[{ts()}] ❌ Connection ACCEPTED (unexpected - should be rejected)")
                 return False
             except websockets.exceptions.ConnectionClosedError as e:
-                if e.code == 1008:
-                    print(f"[{datetime.now().strftime('%H:%M:%S')}] ✅ Connection REJECTED (as expected): {e.reason}")
-                    return True
-                else:
-                    print(f"[{datetime.now().strftime('%H:%M:%S')}] ⚠️  Connection rejected with unexpected code {e.code}: {e}")
-                    return False
+                return _is_rejection(e)
     except websockets.exceptions.ConnectionClosedError as e:
-        if e.code == 1008:
-            print(f"[{datetime.now().strftime('%H:%M:%S')}] ✅ Connection REJECTED (as expected): {e.reason}")
-            return True
-        else:
-            print(f"[{datetime.now().strftime('%H:%M:%S')}] ⚠️  Connection rejected with unexpected code {e.code}: {e}")
-            return False
+        return _is_rejection(e)
     except Exception as e:
-        print(f"[{datetime.now().strftime('%H:%M:%S')}] ⚠️  Unexpected error: {e}")
+        print(f"[{ts()}] ⚠️  Unexpected error: {e}")
         return False
 
 
-async def test_full_flow():
+async def test_full_flow(ws):
     """Test 6: Full end-to-end flow with validation."""
     print(f"\n{'='*60}")
     print("TEST 6: Full End-to-End Flow with Validation")
     print(f"{'='*60}")
     
-    tunnel_id = "tunnel_test123"
-    token = "valid_token_123"
-    slug = "my-slug"
-    
-    print(f"[{datetime.now().strftime('%H:%M:%S')}] 🔌 Connecting agent with valid token...")
+    tunnel_id = TUNNEL_ID
+    slug = SLUG
     
     try:
-        async with websockets.connect(
-            f"{EDGE_WS_URL}/ws/{tunnel_id}",
-            additional_headers={"X-Tunnel-Token": token}
-        ) as ws:
-            print(f"[{datetime.now().strftime('%H:%M:%S')}] ✅ Agent connected")
-            
-            # Start agent handler in background
-            async def agent_handler():
-                while True:
-                    try:
-                        msg = await ws.recv()
-                        data = json.loads(msg)
-                        
-                        if data["type"] == "request":
-                            print(f"[{datetime.now().strftime('%H:%M:%S')}] 📨 Agent received: {data['method']} {data['path']}")
-                            
-                            response = {
-                                "type": "response",
-                                "request_id": data["request_id"],
-                                "status": 200,
-                                "headers": {"Content-Type": "application/json"},
-                                "body": {
-                                    "message": "Hello from validated agent!",
-                                    "tunnel_id": tunnel_id,
-                                    "path": data["path"]
-                                }
-                            }
-                            
-                            await ws.send(json.dumps(response))
-                            print(f"[{datetime.now().strftime('%H:%M:%S')}] 📤 Agent sent response")
-                            break
-                        elif data["type"] == "ping":
-                            await ws.send(json.dumps({"type": "pong"}))
-                    except Exception as e:
-                        print(f"[{datetime.now().strftime('%H:%M:%S')}] Agent error: {e}")
-                        break
-            
-            handler_task = asyncio.create_task(agent_handler())
-            
-            # Give agent a moment to stabilize
-            await asyncio.sleep(0.5)
-            
-            # Make HTTP request
-            print(f"[{datetime.now().strftime('%H:%M:%S')}] 🌐 Making HTTP request to /local_tunnel/{slug}/test")
-            async with httpx.AsyncClient() as client:
-                response = await client.get(
-                    f"{EDGE_GATEWAY_URL}/local_tunnel/{slug}/test",
-                    timeout=10.0
-                )
-                
-                print(f"[{datetime.now().strftime('%H:%M:%S')}] 📥 HTTP Response: {response.status_code}")
+        if ws is None:
+            print(f"[{ts()}] ❌ Agent not connected")
+            return False
+        print(f"[{ts()}] ✅ Agent connected")
+        
+        # Start agent handler in background
+        out = BatchedWS(ws)
+
+        # The Edge keeps the connection alive with native WebSocket pings,
+        # which never reach recv(), so the first frame is the request
+        async def agent_handler():
+            try:
+                raw = await ws.recv()
+                if not frame_startswith(raw, REQUEST_PREFIX):
+                    print(f"[{ts()}] Agent got unexpected frame: {raw[:40]!r}")
+                    return
+                data = orjson.loads(raw)
+                print(f"[{ts()}] 📨 Agent received: {data['method']} {data['path']}")
                 
-                if response.status_code == 200:
-                    body = response.json()
-                    print(f"[{datetime.now().strftime('%H:%M:%S')}] 📄 Response body: {json.dumps(body, indent=2)}")
-                    
-                    if body.get("tunnel_id") == tunnel_id:
-                        print(f"[{datetime.now().strftime('%H:%M:%S')}] ✅ Full flow successful!")
-                        handler_task.cancel()
-                        return True
-                else:
-                    print(f"[{datetime.now().strftime('%H:%M:%S')}] ❌ Unexpected status code")
+                await out.send(
+                    _RESP_PREFIX + orjson.dumps(data["request_id"])
+                    + _RESP_MID + orjson.dumps(data["path"]) + _RESP_SUFFIX
+                )
+                await out.flush()
+                print(f"[{ts()}] 📤 Agent sent response")
+            except Exception as e:
+                print(f"[{ts()}] Agent error: {e}")
+        
+        handler_task = asyncio.create_task(agent_handler())
+        
+        # Give agent a moment to stabilize
+        await asyncio.sleep(0.5)
+        
+        # Make HTTP request
+        print(f"[{ts()}] 🌐 Making HTTP request to /local_tunnel/{slug}/test")
+        client = await get_client()
+        response = await client.get(
+            FULL_FLOW_URL,
+            timeout=10.0
+        )
             
-            handler_task.cancel()
-            return False
+        print(f"[{ts()}] 📥 HTTP Response: {response.status_code}")
             
+        if response.status_code == 200:
+            body = response.json()
+            print(f"[{ts()}] 📄 Response body: {orjson.dumps(body, option=orjson.OPT_INDENT_2).decode()}")
+                
+            if body.get("tunnel_id") == tunnel_id:
+                print(f"[{ts()}] ✅ Full flow successful!")
+                handler_task.cancel()
+                return True
+        else:
+            print(f"[{ts()}] ❌ Unexpected status code")
+        
+        handler_task.cancel()
+        return False
+        
     except Exception as e:
-        print(f"[{datetime.now().strftime('%H:%M:%S')}] ❌ Full flow failed: {e}")
+        print(f"[{ts()}] ❌ Full flow failed: {e}")
         return False
 
 
@@ -313,23 +199,32 @@ async def main():
     
     results = {}
     
-    # Run tests
-    results["valid_token"] = await test_valid_token()
-    await asyncio.sleep(0.5)
-    
-    results["invalid_token"] = await test_invalid_token()
-    await asyncio.sleep(0.5)
-    
-    results["missing_token"] = await test_missing_token()
-    await asyncio.sleep(0.5)
-    
-    results["expired_tunnel"] = await test_expired_tunnel()
-    await asyncio.sleep(0.5)
-    
-    results["revoked_tunnel"] = await test_revoked_tunnel()
-    await asyncio.sleep(0.5)
+    # Rejection tests are closed before any tunnel registers, so they can
+    # run together. They open fresh connections because they exercise
+    # connect-time behaviour.
+    rejection_tests = {
+        "invalid_token": ("TEST 2: Invalid Token Connection", TUNNEL_ID, "wrong_token"),
+        "missing_token": ("TEST 3: Missing Token Connection", TUNNEL_ID, None),
+        "expired_tunnel": ("TEST 4: Expired Tunnel Connection", "tunnel_expired", "expired_token"),
+        "revoked_tunnel": ("TEST 5: Revoked Tunnel Connection", "tunnel_revoked", "revoked_token"),
+    }
+    rejection_results = await asyncio.gather(
+        *(expect_rejected(*args) for args in rejection_tests.values())
+    )
+    
+    # One authenticated agent connection, shared by the positive-path tests
+    # (the Edge allows one connection per tunnel_id)
+    try:
+        pool = await make_pool(EDGE_WS_URL, {TUNNEL_ID: TOKEN})
+    except Exception as e:
+        print(f"[{ts()}] ❌ Connection REJECTED (unexpected): {e}")
+        pool = {}
+    ws = pool.get(TUNNEL_ID)
     
-    results["full_flow"] = await test_full_flow()
+    results["valid_token"] = await test_valid_token(ws)
+    results.update(zip(rejection_tests, rejection_results))
+    results["full_flow"] = await test_full_flow(ws)
+    await close_pool(pool)
     
     # Print summary
     print(f"\n{'='*60}")
@@ -353,5 +248,5 @@ async def main():
 
 
 if __name__ == "__main__":
-    exit_code = asyncio.run(main())
+    exit_code = run(main)
     exit(exit_code)
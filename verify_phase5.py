@@ -4,14 +4,39 @@ Verification script for Phase 5 capabilities.
 Checks all claims made in the roadmap.
 """
 import asyncio
-import httpx
-import json
+from typing import Optional
+import orjson
 import websockets
-from datetime import datetime
 import redis.asyncio as redis
+from phase5_common import (
+    PING, PONG_PREFIX, REQUEST_PREFIX, BatchedWS, close_pool,
+    frame_startswith, get_client, make_pool, run, ws_connect,
+)
 
+EDGE_WS_URL = "ws://localhost:8080"
+EDGE_HTTP_URL = "http://localhost:8080"
+CONTROL_PLANE_URL = "http://localhost:8000"
+TUNNEL_ID = "tunnel_test123"
+TOKEN = "valid_token_123"
+SLUG = "my-slug"
+# Longer than the Edge's WS_PING_INTERVAL_SECONDS (10s), so a server PING must arrive
+SERVER_PING_WAIT = 15
 
-async def verify_1_tunnel_connections():
+# URLs built once instead of per call
+AGENT_WS_URL = f"{EDGE_WS_URL}/ws/{TUNNEL_ID}"
+SLUG_URL = f"{EDGE_HTTP_URL}/local_tunnel/{SLUG}/test"
+CP_RESOLVE_URL = f"{CONTROL_PLANE_URL}/api/tunnels/resolve/{SLUG}"
+CP_VALIDATE_URL = f"{CONTROL_PLANE_URL}/api/tunnels/validate"
+CP_STATS_URL = f"{CONTROL_PLANE_URL}/api/stats/validations"
+
+# One pooled Redis client for every verification, closed at the end of main
+_REDIS = redis.Redis(
+    host="localhost", port=6379, db=0, decode_responses=True,
+    max_connections=16, socket_keepalive=True
+)
+
+
+async def verify_1_tunnel_connections(ws):
     """
     Verify: Accept real tunnel connections with heartbeats
     """
@@ -19,39 +44,38 @@ async def verify_1_tunnel_connections():
     print("VERIFICATION 1: Real Tunnel Connections")
     print("="*60)
     
-    tunnel_id = "tunnel_test123"
-    token = "valid_token_123"
-    
     try:
-        async with websockets.connect(
-            "ws://localhost:8080/ws/" + tunnel_id,
-            additional_headers={"X-Tunnel-Token": token}
-        ) as ws:
-            print("✅ WebSocket connection accepted")
-            
-            # Test heartbeat
-            await ws.send(json.dumps({"type": "ping"}))
-            response = await asyncio.wait_for(ws.recv(), timeout=2)
-            data = json.loads(response)
-            
-            if data["type"] == "pong":
-                print("✅ Heartbeat working (ping/pong)")
-            
-            # Wait for server ping
-            msg = await asyncio.wait_for(ws.recv(), timeout=12)
-            server_ping = json.loads(msg)
-            if server_ping["type"] == "ping":
-                print("✅ Server initiated heartbeat received")
-                await ws.send(json.dumps({"type": "pong"}))
-                print("✅ Responded to server ping")
-            
-            return True
+        if ws is None:
+            print("❌ Failed: agent connection was not accepted")
+            return False
+        print("✅ WebSocket connection accepted")
+        
+        # Test heartbeat
+        await ws.send(PING)
+        async with asyncio.timeout(2):
+            response = await ws.recv()
+        
+        if frame_startswith(response, PONG_PREFIX):
+            print("✅ Heartbeat working (ping/pong)")
+        
+        # Server keepalive uses native WebSocket PING control frames; the
+        # client library answers each with a PONG
+        ws.server_ping.clear()
+        try:
+            async with asyncio.timeout(SERVER_PING_WAIT):
+                await ws.server_ping.wait()
+        except TimeoutError:
+            print(f"❌ No server PING within {SERVER_PING_WAIT}s (uvicorn ws_ping_interval not applied?)")
+            return False
+        print("✅ Server keepalive PING received and answered with PONG")
+        
+        return True
     except Exception as e:
         print(f"❌ Failed: {e}")
         return False
 
 
-async def verify_2_http_routing():
+async def verify_2_http_routing(ws):
     """
     Verify: Route public HTTP into tunnels (full flow)
     """
@@ -59,66 +83,110 @@ async def verify_2_http_routing():
     print("VERIFICATION 2: HTTP → Tunnel Routing")
     print("="*60)
     
-    tunnel_id = "tunnel_test123"
-    token = "valid_token_123"
-    slug = "my-slug"
+    tunnel_id = TUNNEL_ID
+    slug = SLUG
     
     try:
-        # Connect agent
-        async with websockets.connect(
-            "ws://localhost:8080/ws/" + tunnel_id,
-            additional_headers={"X-Tunnel-Token": token}
-        ) as ws:
-            print(f"✅ Agent connected (tunnel_id={tunnel_id})")
-            
-            # Background handler
-            async def handler():
-                while True:
-                    msg = await ws.recv()
-                    data = json.loads(msg)
-                    
-                    if data["type"] == "request":
-                        print(f"✅ Tunnel received: {data['method']} {data['path']}")
-                        
-                        # Send response
-                        await ws.send(json.dumps({
-                            "type": "response",
-                            "request_id": data["request_id"],
-                            "status": 200,
-                            "headers": {"Content-Type": "text/plain"},
-                            "body": "Hello from behind NAT!"
-                        }))
-                        print("✅ Tunnel sent response")
-                        break
-                    elif data["type"] == "ping":
-                        await ws.send(json.dumps({"type": "pong"}))
-            
-            task = asyncio.create_task(handler())
-            await asyncio.sleep(0.3)
-            
-            # Make HTTP request
-            print(f"✅ Making public HTTP request to /local_tunnel/{slug}/test")
-            async with httpx.AsyncClient() as client:
-                response = await client.get(
-                    f"http://localhost:8080/local_tunnel/{slug}/test",
-                    timeout=5.0
-                )
+        print(f"✅ Agent connected (tunnel_id={tunnel_id})")
+        
+        # Background handler
+        out = BatchedWS(ws)
+
+        # Native WebSocket pings never reach recv(), so the first frame
+        # is the request
+        async def handler():
+            raw = await ws.recv()
+            if frame_startswith(raw, REQUEST_PREFIX):
+                data = orjson.loads(raw)
+                print(f"✅ Tunnel received: {data['method']} {data['path']}")
                 
-                if response.status_code == 200:
-                    print(f"✅ HTTP response received: {response.status_code}")
-                    print(f"✅ Body: {response.text}")
-                    task.cancel()
-                    return True
-                else:
-                    print(f"❌ Unexpected status: {response.status_code}")
-                    task.cancel()
-                    return False
+                # Send response
+                await out.send({
+                    "type": "response",
+                    "request_id": data["request_id"],
+                    "status": 200,
+                    "headers": {"Content-Type": "text/plain"},
+                    "body": "Hello from behind NAT!"
+                })
+                await out.flush()
+                print("✅ Tunnel sent response")
+        
+        task = asyncio.create_task(handler())
+        await asyncio.sleep(0.3)
+        
+        # Make HTTP request
+        print(f"✅ Making public HTTP request to /local_tunnel/{slug}/test")
+        client = await get_client()
+        response = await client.get(
+            SLUG_URL,
+            timeout=5.0
+        )
+        
+        if response.status_code == 200:
+            print(f"✅ HTTP response received: {response.status_code}")
+            print(f"✅ Body: {response.text}")
+            task.cancel()
+            return True
+        else:
+            print(f"❌ Unexpected status: {response.status_code}")
+            task.cancel()
+            return False
     except Exception as e:
         print(f"❌ Failed: {e}")
         return False
 
 
-async def verify_3_redis_state():
+async def _enable_keyspace_events(r) -> Optional[str]:
+    """
+    Turn on keyspace notifications for string commands, keeping existing
+    flags. Returns the original setting for _restore_keyspace_events, or
+    None if CONFIG is not permitted.
+    """
+    try:
+        flags = (await r.config_get("notify-keyspace-events")).get("notify-keyspace-events", "")
+        if "K" not in flags or not ("$" in flags or "A" in flags):
+            await r.config_set("notify-keyspace-events", flags + "K$")
+        return flags
+    except redis.ResponseError:
+        # CONFIG disabled (e.g. managed Redis): fall back to a one-off wait
+        return None
+
+
+async def _restore_keyspace_events(r, flags: str):
+    """Put notify-keyspace-events back the way _enable_keyspace_events found it."""
+    try:
+        await r.config_set("notify-keyspace-events", flags)
+    except redis.RedisError as e:
+        print(f"⚠️  Could not restore notify-keyspace-events={flags!r}: {e}")
+
+
+async def _wait_for_key(r, pubsub, key: str, timeout: float = 2.0, poll: float = 0.05):
+    """
+    Wait for key to appear and return its value (None if it never does).
+
+    GETs every `poll` seconds; when pubsub is subscribed to the key's
+    keyspace channel, a notification cuts the current poll short, so a
+    write made before the subscription landed is still seen by the GET.
+    """
+    channel = f"__keyspace@0__:{key}"
+    loop = asyncio.get_running_loop()
+    deadline = loop.time() + timeout
+    while (remaining := deadline - loop.time()) > 0:
+        if pubsub is None:
+            await asyncio.sleep(min(poll, remaining))
+        else:
+            message = await pubsub.get_message(
+                ignore_subscribe_messages=True, timeout=min(poll, remaining)
+            )
+            if message and message["channel"] != channel:
+                continue
+        value = await r.get(key)
+        if value is not None:
+            return value
+    return None
+
+
+async def verify_3_redis_state(ws):
     """
     Verify: Redis stores tunnel registry and slug cache
     """
@@ -126,81 +194,102 @@ async def verify_3_redis_state():
     print("VERIFICATION 3: Redis Shared State")
     print("="*60)
     
-    tunnel_id = "tunnel_test123"
-    token = "valid_token_123"
-    slug = "my-slug"
+    tunnel_id = TUNNEL_ID
+    slug = SLUG
+    
+    r = _REDIS
+    tunnel_key = f"tunnel:{tunnel_id}"
+    slug_key = f"slug:{slug}"
+    pubsub = None
+    original_flags = None
     
-    # Connect to Redis
-    r = redis.Redis(host="localhost", port=6379, db=0, decode_responses=True)
+    async def subscribe():
+        # Assigned before subscribing so the finally below always cleans up
+        nonlocal pubsub, original_flags
+        original_flags = await _enable_keyspace_events(r)
+        if original_flags is not None:
+            pubsub = r.pubsub()
+            await pubsub.subscribe(
+                *(f"__keyspace@0__:{key}" for key in (tunnel_key, slug_key))
+            )
+    
+    async def registry_lookup():
+        # The ping rides along with the registry lookup in one round trip
+        async with r.pipeline(transaction=False) as pipe:
+            pipe.ping()
+            pipe.get(tunnel_key)
+            _, pod = await pipe.execute()
+        return pod
     
     try:
-        await r.ping()
+        # The shared agent connection should already be registered, so the
+        # keyspace subscription (a separate connection) is set up alongside
+        # the lookup. A key written before the subscription lands is still
+        # picked up by _wait_for_key's polling GET.
+        async with asyncio.TaskGroup() as tg:
+            tg.create_task(subscribe())
+            lookup_task = tg.create_task(registry_lookup())
+        pod_id = lookup_task.result()
         print("✅ Redis connection working")
+        if pod_id is None:
+            pod_id = await _wait_for_key(r, pubsub, tunnel_key)
         
-        # Connect a tunnel
-        async with websockets.connect(
-            "ws://localhost:8080/ws/" + tunnel_id,
-            additional_headers={"X-Tunnel-Token": token}
-        ) as ws:
-            await asyncio.sleep(0.3)
-            
-            # Check tunnel registry
-            tunnel_key = f"tunnel:{tunnel_id}"
-            pod_id = await r.get(tunnel_key)
-            
-            if pod_id:
-                print(f"✅ Tunnel registry: tunnel:{tunnel_id} → {pod_id}")
-            else:
-                print("❌ Tunnel not found in Redis")
-                return False
-            
-            # Check pod mapping
-            pod_tunnels = await r.smembers(f"pod:{pod_id}:tunnels")
-            if tunnel_id in pod_tunnels:
-                print(f"✅ Pod mapping: pod:{pod_id}:tunnels contains {tunnel_id}")
-            else:
-                print("❌ Pod tunnels set not updated")
-                return False
+        if pod_id:
+            print(f"✅ Tunnel registry: tunnel:{tunnel_id} → {pod_id}")
+        else:
+            print("❌ Tunnel not found in Redis")
+            return False
         
-        # Make HTTP request to populate slug cache
-        async with websockets.connect(
-            "ws://localhost:8080/ws/" + tunnel_id,
-            additional_headers={"X-Tunnel-Token": token}
-        ) as ws:
-            async def handler():
-                msg = await ws.recv()
-                data = json.loads(msg)
-                if data["type"] == "request":
-                    await ws.send(json.dumps({
-                        "type": "response",
-                        "request_id": data["request_id"],
-                        "status": 200,
-                        "headers": {},
-                        "body": "ok"
-                    }))
-            
-            task = asyncio.create_task(handler())
-            
-            async with httpx.AsyncClient() as client:
-                await client.get(f"http://localhost:8080/local_tunnel/{slug}/test")
-            
-            task.cancel()
+        # Make HTTP request to populate slug cache, answered on the same ws
+        async def handler():
+            msg = await ws.recv()
+            if frame_startswith(msg, REQUEST_PREFIX):
+                data = orjson.loads(msg)
+                await ws.send(orjson.dumps({
+                    "type": "response",
+                    "request_id": data["request_id"],
+                    "status": 200,
+                    "headers": {},
+                    "body": "ok"
+                }))
+        
+        task = asyncio.create_task(handler())
+        
+        # The pod mapping check does not depend on the HTTP trigger, so
+        # both are in flight together
+        client = await get_client()
+        async with asyncio.TaskGroup() as tg:
+            tg.create_task(client.get(SLUG_URL))
+            in_pod_task = tg.create_task(r.sismember(f"pod:{pod_id}:tunnels", tunnel_id))
+        in_pod = in_pod_task.result()
+        
+        task.cancel()
+        
+        slug_cache = await r.get(slug_key)
+        if slug_cache is None:
+            slug_cache = await _wait_for_key(r, pubsub, slug_key)
+        
+        if in_pod:
+            print(f"✅ Pod mapping: pod:{pod_id}:tunnels contains {tunnel_id}")
+        else:
+            print("❌ Pod tunnels set not updated")
+            return False
         
-        # Check slug cache
-        await asyncio.sleep(0.2)
-        slug_cache = await r.get(f"slug:{slug}")
         if slug_cache == tunnel_id:
             print(f"✅ Slug cache: slug:{slug} → {tunnel_id}")
         else:
             print(f"⚠️  Slug cache not found (may have expired)")
         
-        await r.close()
         return True
         
     except Exception as e:
         print(f"❌ Failed: {e}")
-        await r.close()
         return False
+    finally:
+        if pubsub is not None:
+            await pubsub.aclose()
+        if original_flags is not None:
+            await _restore_keyspace_events(r, original_flags)
 
 
 async def verify_4_control_plane_validation():
@@ -213,51 +302,50 @@ async def verify_4_control_plane_validation():
     
     try:
         # Test 1: Slug resolution
-        async with httpx.AsyncClient() as client:
-            response = await client.get("http://localhost:8000/api/tunnels/resolve/my-slug")
-            if response.status_code == 200:
-                data = response.json()
-                print(f"✅ Slug resolution: my-slug → {data['tunnel_id']}")
-            else:
-                print("❌ Slug resolution failed")
-                return False
+        client = await get_client()
+        response = await client.get(CP_RESOLVE_URL)
+        if response.status_code == 200:
+            data = response.json()
+            print(f"✅ Slug resolution: my-slug → {data['tunnel_id']}")
+        else:
+            print("❌ Slug resolution failed")
+            return False
         
         # Test 2: Valid token validation
-        async with httpx.AsyncClient() as client:
-            response = await client.post(
-                "http://localhost:8000/api/tunnels/validate",
-                json={"tunnel_id": "tunnel_test123", "token": "valid_token_123"}
-            )
-            if response.status_code == 200:
-                data = response.json()
-                if data.get("valid"):
-                    print(f"✅ Token validation: valid token accepted")
-                else:
-                    print("❌ Valid token rejected")
-                    return False
+        response = await client.post(
+            CP_VALIDATE_URL,
+            json={"tunnel_id": "tunnel_test123", "token": "valid_token_123"}
+        )
+        if response.status_code == 200:
+            data = response.json()
+            if data.get("valid"):
+                print(f"✅ Token validation: valid token accepted")
             else:
-                print("❌ Token validation failed")
+                print("❌ Valid token rejected")
                 return False
+        else:
+            print("❌ Token validation failed")
+            return False
         
         # Test 3: Invalid token rejected
-        async with httpx.AsyncClient() as client:
-            response = await client.post(
-                "http://localhost:8000/api/tunnels/validate",
-                json={"tunnel_id": "tunnel_test123", "token": "wrong_token"}
-            )
-            if response.status_code == 401:
-                print(f"✅ Token validation: invalid token rejected (401)")
-            else:
-                print(f"⚠️  Expected 401, got {response.status_code}")
+        response = await client.post(
+            CP_VALIDATE_URL,
+            json={"tunnel_id": "tunnel_test123", "token": "wrong_token"}
+        )
+        if response.status_code == 401:
+            print(f"✅ Token validation: invalid token rejected (401)")
+        else:
+            print(f"⚠️  Expected 401, got {response.status_code}")
         
         # Test 4: Edge rejects invalid tokens
         try:
-            async with websockets.connect(
-                "ws://localhost:8080/ws/tunnel_test123",
+            async with ws_connect(
+                AGENT_WS_URL,
                 additional_headers={"X-Tunnel-Token": "wrong_token"}
             ) as ws:
                 try:
-                    await asyncio.wait_for(ws.recv(), timeout=1)
+                    async with asyncio.timeout(1):
+                        await ws.recv()
                     print("❌ Edge accepted invalid token")
                     return False
                 except websockets.exceptions.ConnectionClosedError as e:
@@ -276,6 +364,53 @@ async def verify_4_control_plane_validation():
         return False
 
 
+async def verify_5_token_cache():
+    """
+    Verify: Repeat connections within TUNNEL_VALIDATION_TTL reuse the Edge's
+    cached validation instead of calling the Control Plane again.
+
+    The Edge caches successful validations in-process, keyed by a salted
+    blake2b of (tunnel_id, token). The mock CP counts validate calls: against
+    the real CP exactly one is expected. A delta of 0 means the Edge is in mock
+    mode and never calls the CP, so the check is skipped (returns None).
+    Needs the agent pool closed, since the Edge allows one connection per tunnel_id.
+    """
+    print("\n" + "="*60)
+    print("VERIFICATION 5: Cached Tunnel Validation")
+    print("="*60)
+
+    try:
+        client = await get_client()
+        before = (await client.get(CP_STATS_URL)).json()["validations"]
+
+        for attempt in (1, 2):
+            async with ws_connect(
+                AGENT_WS_URL,
+                additional_headers={"X-Tunnel-Token": TOKEN}
+            ) as ws:
+                await ws.send(PING)
+                async with asyncio.timeout(2):
+                    response = await ws.recv()
+                if not frame_startswith(response, PONG_PREFIX):
+                    print(f"❌ Connection {attempt} not usable: {response!r}")
+                    return False
+            print(f"✅ Connection {attempt} accepted")
+
+        delta = (await client.get(CP_STATS_URL)).json()["validations"] - before
+        if delta == 1:
+            print(f"✅ Control Plane validate calls for 2 connections: {delta}")
+            return True
+        if delta == 0:
+            print("⚠️  SKIP: no validate calls reached the Control Plane (Edge in mock mode)")
+            return None
+        print(f"❌ Expected exactly 1 validate call, got {delta}")
+        return False
+
+    except Exception as e:
+        print(f"❌ Failed: {e}")
+        return False
+
+
 async def main():
     """Run all verifications"""
     print("\n" + "="*60)
@@ -285,16 +420,23 @@ async def main():
     
     results = {}
     
-    results["tunnel_connections"] = await verify_1_tunnel_connections()
-    await asyncio.sleep(0.5)
-    
-    results["http_routing"] = await verify_2_http_routing()
-    await asyncio.sleep(0.5)
+    # One authenticated agent connection, opened up front and shared by the
+    # positive-path checks (the Edge allows one connection per tunnel_id)
+    try:
+        pool = await make_pool(EDGE_WS_URL, {TUNNEL_ID: TOKEN})
+    except Exception as e:
+        print(f"❌ Agent connection failed: {e}")
+        pool = {}
+    ws = pool.get(TUNNEL_ID)
     
-    results["redis_state"] = await verify_3_redis_state()
-    await asyncio.sleep(0.5)
+    results["tunnel_connections"] = await verify_1_tunnel_connections(ws)
+    results["http_routing"] = await verify_2_http_routing(ws)
+    results["redis_state"] = await verify_3_redis_state(ws)
+    await close_pool(pool)
     
     results["control_plane"] = await verify_4_control_plane_validation()
+    results["token_cache"] = await verify_5_token_cache()
+    await _REDIS.aclose()
     
     # Summary
     print("\n" + "="*60)
@@ -305,15 +447,20 @@ async def main():
         "tunnel_connections": "1️⃣ Accept real tunnel connections",
         "http_routing": "2️⃣ Route public HTTP into tunnels",
         "redis_state": "3️⃣ Use Redis as shared routing state",
-        "control_plane": "4️⃣ Validate tunnels via Control Plane"
+        "control_plane": "4️⃣ Validate tunnels via Control Plane",
+        "token_cache": "5️⃣ Reuse cached tunnel validations"
     }
     
     for key, claim in claims.items():
-        status = "✅ VERIFIED" if results[key] else "❌ FAILED"
+        if results[key] is None:
+            status = "⏭️  SKIPPED"
+        else:
+            status = "✅ VERIFIED" if results[key] else "❌ FAILED"
         print(f"{claim:45s} {status}")
     
-    total = len(results)
-    passed = sum(results.values())
+    # Skipped checks (None) count neither as passed nor towards the total
+    total = sum(r is not None for r in results.values())
+    passed = sum(r is True for r in results.values())
     
     print(f"\nResult: {passed}/{total} capabilities verified")
     
@@ -331,5 +478,5 @@ async def main():
 
 
 if __name__ == "__main__":
-    exit_code = asyncio.run(main())
+    exit_code = run(main)
     exit(exit_code)